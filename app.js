@@ -102,6 +102,22 @@ app.post('/api/attendance', (req, res) => {
   }
 });
 
+// Bulk variant used by the listener's batch mode: body is an array of the
+// same payloads accepted above, broadcast one by one so clients are unchanged
+app.post('/api/attendance/bulk', (req, res) => {
+  try {
+    // A non-2xx reply keeps the batch in the listener's outbox
+    if (!Array.isArray(req.body)) {
+      return res.status(400).json({ ok: false, error: 'body must be an array' });
+    }
+    const payloads = req.body;
+    payloads.forEach((payload) => io.emit('attendance', payload || {}));
+    res.json({ ok: true, count: payloads.length });
+  } catch (error) {
+    res.status(500).json({ ok: false, error: error?.message || 'unknown error' });
+  }
+});
+
 app.use((req, res) => {
   res.status(404).render('404', { title: '404' });
 });
@@ -1,15 +1,34 @@
 from zk import ZK, const
+from zk.exception import ZKErrorConnection, ZKErrorResponse, ZKNetworkError
+from zk.user import User
+from zk.attendance import Attendance
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import threading
 from datetime import datetime
 import socket
 import json
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait
 import sys
 import io
-
-from flask import Flask, jsonify, request, render_template_string
+import sqlite3
+import heapq
+import random
+import asyncio
+import ipaddress
+import queue
+import struct
+import itertools
+import logging
+import logging.handlers
+import atexit
+import copy
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import Flask, Response, g, jsonify, request, render_template_string
 import os
 from flask_cors import CORS
 
@@ -26,10 +45,179 @@ DEFAULT_DEVICES = [
 ]
 
 NODE_API = "http://localhost:8721/api/attendance"
+NODE_BULK_API = "http://localhost:8721/api/attendance/bulk"
 FLASK_HOST = "0.0.0.0"
 FLASK_PORT = 5001
 AUTO_LISTEN = os.environ.get("AUTO_LISTEN", "1") not in ("0", "false", "False")
 
+# "waitress" serves the API from a thread pool in this process; "dev" uses the
+# Flask development server. Each streaming dashboard or scan holds one thread.
+SERVER = os.environ.get("LISTENER_SERVER", "waitress").lower()
+SERVER_THREADS = int(os.environ.get("LISTENER_THREADS", "32"))
+SERVER_CONNECTION_LIMIT = int(os.environ.get("LISTENER_CONNECTION_LIMIT", "200"))
+# Only the process holding an exclusive lock on this file may talk to the devices
+LOCK_FILE = os.environ.get(
+    "LISTENER_LOCK_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "listener.lock")
+)
+
+# Listener mode: "live" uses the device's real-time event stream (falls back to
+# polling on firmware without it), "poll" reads the attendance log on a schedule
+LISTEN_MODE = os.environ.get("LISTEN_MODE", "live").lower()
+# Poll intervals adapt per device: back to POLL_INTERVAL as soon as a poll finds
+# punches, stretching by POLL_BACKOFF_FACTOR per quiet poll up to POLL_MAX_INTERVAL
+# during WORKING_HOURS ("start-end", 24h clock) and POLL_OFF_HOURS_INTERVAL outside
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", "1"))
+POLL_MAX_INTERVAL = float(os.environ.get("POLL_MAX_INTERVAL", "10"))
+POLL_OFF_HOURS_INTERVAL = float(os.environ.get("POLL_OFF_HOURS_INTERVAL", "60"))
+POLL_BACKOFF_FACTOR = 1.5
+WORKING_HOURS = tuple(int(h) for h in os.environ.get("WORKING_HOURS", "6-20").split("-"))
+# Each interval is randomised by +/- this fraction so devices never poll in lockstep
+POLL_JITTER = float(os.environ.get("POLL_JITTER", "0.2"))
+# Reconnects back off exponentially (with full jitter) per failure class. After
+# BREAKER_THRESHOLD straight network failures a device's breaker opens: no ZK
+# connects, just a cheap TCP probe every ~BREAKER_PROBE_INTERVAL until it answers
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", "3"))
+BREAKER_MAX_DELAY = float(os.environ.get("BREAKER_MAX_DELAY", "60"))
+BREAKER_PROBE_INTERVAL = float(os.environ.get("BREAKER_PROBE_INTERVAL", "5"))
+BREAKER_PROBE_TIMEOUT = 1
+# First retry delay per failure class, in seconds
+FAILURE_BASE_DELAY = {"network": 1, "refused": 2, "auth": 30, "other": 5}
+# At most this many devices are polled (or catching up after a reconnect) at once
+POLL_CONCURRENCY = int(os.environ.get("POLL_CONCURRENCY", "8"))
+# How long a live capture read blocks before checking for a stop request
+LIVE_CAPTURE_TIMEOUT = int(os.environ.get("LIVE_CAPTURE_TIMEOUT", "1"))
+# Polls download the attendance log in chunks of this many bytes (capped at the
+# protocol maximum), decoding and forwarding records while the rest arrives
+ATTENDANCE_CHUNK_SIZE = int(os.environ.get("ATTENDANCE_CHUNK_SIZE", str(0xFFC0)))
+ATTENDANCE_FORWARD_BATCH = int(os.environ.get("ATTENDANCE_FORWARD_BATCH", "500"))
+
+# Per-device attendance cursors survive restarts in this file
+STATE_FILE = os.environ.get(
+    "LISTENER_STATE_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "listener_state.json")
+)
+# Live punches move the cursor one record at a time; those moves are written
+# out at most this often. Delivery is at least once: after a crash up to this
+# much of the live punches is read back and sent to Node again, since the
+# dedup index only lives in memory
+CURSOR_SAVE_INTERVAL = float(os.environ.get("CURSOR_SAVE_INTERVAL", "2"))
+# Device configuration (id, name, ip, port, enabled) is kept in this file; it is
+# seeded from DEFAULT_DEVICES on first run and re-read when edited by hand
+DEVICES_FILE = os.environ.get(
+    "LISTENER_DEVICES_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "listener_devices.json")
+)
+DEVICES_WATCH_INTERVAL = float(os.environ.get("DEVICES_WATCH_INTERVAL", "2"))
+DEVICE_CONFIG_FIELDS = ("id", "name", "ip", "port", "enabled")
+# Hour of day (0-23) after which each device log is cleared once a day; unset disables clearing
+COMPACT_AT_HOUR = int(os.environ["COMPACT_AT_HOUR"]) if os.environ.get("COMPACT_AT_HOUR") else None
+
+# Punches already forwarded are remembered by (device serial, user_id, time) so a
+# re-read log never reaches Node twice; the oldest keys are evicted past DEDUP_CAPACITY.
+# With DEDUP_WINDOW > 0, a user's further punches within that many seconds of
+# their last forwarded one (a double tap) are dropped too.
+DEDUP_CAPACITY = int(os.environ.get("DEDUP_CAPACITY", "100000"))
+DEDUP_WINDOW = float(os.environ.get("DEDUP_WINDOW", "0"))
+
+# Punches are written to this SQLite outbox before a sender thread delivers them to Node
+OUTBOX_FILE = os.environ.get(
+    "LISTENER_OUTBOX_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "listener_outbox.db")
+)
+OUTBOX_FETCH_SIZE = 100
+OUTBOX_RETRY_MIN_DELAY = 1  # seconds
+OUTBOX_RETRY_MAX_DELAY = 30  # seconds
+# A poll that finds at least BACKFILL_THRESHOLD new punches (a device catching up
+# after an outage or restart) queues them as backlog: sent to NODE_BULK_API in
+# batches of BACKFILL_BATCH_SIZE at no more than BACKFILL_RATE punches a second,
+# and only while no live punch is waiting
+BACKFILL_THRESHOLD = int(os.environ.get("BACKFILL_THRESHOLD", "20"))
+BACKFILL_BATCH_SIZE = int(os.environ.get("BACKFILL_BATCH_SIZE", "500"))
+BACKFILL_RATE = float(os.environ.get("BACKFILL_RATE", "200"))
+
+# Every captured punch is also kept in this SQLite history, queried by
+# /api/attendance so reports never have to read the terminals
+HISTORY_FILE = os.environ.get(
+    "LISTENER_HISTORY_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "listener_history.db")
+)
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 1000
+
+# Batch mode groups queued punches into one POST to NODE_BULK_API, sent when
+# NODE_BATCH_SIZE punches are waiting or NODE_BATCH_WINDOW seconds have passed
+NODE_BATCH_MODE = os.environ.get("NODE_BATCH_MODE", "0") not in ("0", "false", "False")
+NODE_BATCH_SIZE = int(os.environ.get("NODE_BATCH_SIZE", "100"))
+NODE_BATCH_WINDOW = float(os.environ.get("NODE_BATCH_WINDOW", "0.2"))
+
+# Keep-alive HTTP session used for every delivery to Node
+NODE_POOL_SIZE = int(os.environ.get("NODE_POOL_SIZE", "4"))
+NODE_RETRIES = int(os.environ.get("NODE_RETRIES", "2"))
+NODE_RETRY_BACKOFF = float(os.environ.get("NODE_RETRY_BACKOFF", "0.2"))
+NODE_CONNECT_TIMEOUT = float(os.environ.get("NODE_CONNECT_TIMEOUT", "1"))
+NODE_READ_TIMEOUT = float(os.environ.get("NODE_READ_TIMEOUT", "3"))
+
+# Shared ZK sessions: how long a caller waits for exclusive use of a device, and
+# how long a session may sit idle before it is health-checked on the next lease
+SESSION_LEASE_TIMEOUT = float(os.environ.get("SESSION_LEASE_TIMEOUT", "30"))
+SESSION_HEALTHCHECK_AFTER = float(os.environ.get("SESSION_HEALTHCHECK_AFTER", "15"))
+
+# Command priorities on a device's queue (lower runs first)
+PRIORITY_ENROL = 0  # user writes and deletes
+PRIORITY_ADMIN = 5  # reads and maintenance from the API
+PRIORITY_POLL = 9   # routine attendance polling and live capture
+
+# Multi-device API calls run on all devices in parallel and answer within this many seconds
+FANOUT_DEADLINE = float(os.environ.get("FANOUT_DEADLINE", "10"))
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", "16"))
+# Bulk enrolment writes hundreds of users per device, so it gets a longer deadline
+BULK_ENROL_DEADLINE = float(os.environ.get("BULK_ENROL_DEADLINE", "900"))
+
+# Device user lists are cached in memory; after this many seconds a cached list
+# is revalidated against the device's user count before it is served again
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "300"))
+
+# Network scans first probe port 4370 on every host concurrently, then
+# fingerprint only the hosts that answered with a real ZK handshake
+SCAN_PROBE_TIMEOUT = float(os.environ.get("SCAN_PROBE_TIMEOUT", "1"))
+SCAN_CONCURRENCY = int(os.environ.get("SCAN_CONCURRENCY", "512"))
+SCAN_FINGERPRINT_TIMEOUT = float(os.environ.get("SCAN_FINGERPRINT_TIMEOUT", "2"))
+SCAN_FINGERPRINT_WORKERS = int(os.environ.get("SCAN_FINGERPRINT_WORKERS", "32"))
+SCAN_MAX_HOSTS = 65536
+
+# Dashboards subscribe to /api/events instead of polling; each subscriber
+# buffers this many events before it is resynced with a fresh snapshot
+EVENT_QUEUE_SIZE = 1000
+EVENT_KEEPALIVE = 15  # seconds between keep-alive comments on an idle stream
+
+# Metrics exposed on /metrics in the Prometheus text format: name -> (type, help, buckets)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RECORD_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 500)
+METRICS = {
+    "zk_poll_duration_seconds": ("histogram", "Time to check a device for new punches and forward them", LATENCY_BUCKETS),
+    "zk_poll_records": ("histogram", "New punches found per poll", RECORD_BUCKETS),
+    "zk_connect_duration_seconds": ("histogram", "ZK connect handshake time", LATENCY_BUCKETS),
+    "zk_reconnects_total": ("counter", "Listener connections established to a device", None),
+    "zk_listener_failures_total": ("counter", "Listener failures by failure class", None),
+    "zk_punches_total": ("counter", "Punches read from devices", None),
+    "zk_suppressed_punches_total": ("counter", "Punches not forwarded to Node, by reason", None),
+    "node_delivery_duration_seconds": ("histogram", "Time for Node to accept one delivery", LATENCY_BUCKETS),
+    "node_delivery_failures_total": ("counter", "Deliveries to Node that failed and will be retried", None),
+    "node_delivered_punches_total": ("counter", "Punches accepted by Node", None),
+    "http_request_duration_seconds": ("histogram", "API request latency by route", LATENCY_BUCKETS),
+}
+
+# Logging goes through a queue to a background writer thread, so callers never
+# wait on the console. LOG_FORMAT is "text" or "json" (one object per line).
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+# At most LOG_RATE_LIMIT lines per message and device every LOG_RATE_WINDOW
+# seconds; the next line that gets through reports how many were dropped
+LOG_RATE_LIMIT = int(os.environ.get("LOG_RATE_LIMIT", "20"))
+LOG_RATE_WINDOW = float(os.environ.get("LOG_RATE_WINDOW", "10"))
+LOG_RATE_KEYS = 1000
+
 app = Flask(__name__)
 CORS(app)
 
@@ -40,39 +228,215 @@ app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
 # Add error handler for Unicode encoding issues
 @app.errorhandler(UnicodeEncodeError)
 def handle_unicode_error(e):
-    safe_print(f"Unicode encoding error: {e}")
+    log.error("Unicode encoding error: %s", e)
     return jsonify({"ok": False, "error": "Unicode encoding error occurred"}), 500
 
 # Add error handler for general encoding issues
 @app.errorhandler(Exception)
 def handle_general_error(e):
-    safe_print(f"General error: {e}")
+    log.exception("General error: %s", e)
     return jsonify({"ok": False, "error": "An error occurred while processing the request"}), 500
 
-# Global device management
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_latency(response):
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        observe(
+            "http_request_duration_seconds",
+            time.perf_counter() - started,
+            route=request.url_rule.rule if request.url_rule else "unmatched",
+            method=request.method,
+            status=response.status_code
+        )
+    return response
+
+# Global device management. These four are copy-on-write: a published dict
+# is never mutated, writers build a new one under registry_lock and swap it
+# in, so any thread can read or iterate them without taking the lock.
 devices = {}
 listen_threads = {}
 listen_stop_events = {}
 listen_status = {"running": False, "last_error": None, "devices": {}}
+registry_lock = threading.RLock()
+poll_slots = threading.BoundedSemaphore(POLL_CONCURRENCY)
+# Next number for device_<n> IDs; persisted so deleted IDs are never reused
+device_store_next_id = 1
+# (mtime, size) of DEVICES_FILE when it was last read or written
+device_store_signature = None
+attendance_cursors = {}
+cursor_lock = threading.Lock()
+cursor_dirty = False  # attendance_cursors has changes not yet in STATE_FILE
+cursor_saved_at = 0
+outbox_db = None
+outbox_lock = threading.Lock()
+outbox_wakeup = threading.Event()
+outbox_stop_event = threading.Event()
+outbox_thread = None
+history_db = None
+history_lock = threading.Lock()
+forwarded_punches = OrderedDict()  # (device serial, user_id, time) -> None, oldest first
+last_user_punch = OrderedDict()  # user_id -> time of their last forwarded punch
+dedup_lock = threading.Lock()
+node_session = None
+node_session_lock = threading.Lock()
+device_sessions = {}
+device_sessions_lock = threading.Lock()
+lease_sequence = itertools.count()
+device_fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS)
+metric_values = {}  # (name, labels) -> counter value or [bucket counts, sum, count]
+metrics_lock = threading.Lock()
+user_directories = {}
+user_directories_lock = threading.Lock()
+
+# Streaming scans in progress: scan id -> cancel event
+active_scans = {}
+active_scans_lock = threading.Lock()
+scan_sequence = itertools.count(1)
+
+# Process-wide startup state, see start_service()
+service_started = False
+service_lock = threading.Lock()
+instance_lock = None
+
+# Push channel: one queue of pre-formatted SSE messages per connected dashboard
+event_subscribers = set()
+event_subscribers_lock = threading.Lock()
+
+# Logging pipeline, see configure_logging()
+log = logging.getLogger("listener")
+log_listener = None
+log_rate_state = {}  # (message template, device id) -> [window start, emitted, suppressed]
+log_rate_lock = threading.Lock()
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.device is not None:
+            entry["device"] = record.device
+            entry["deviceName"] = record.device_name
+        if record.suppressed:
+            entry["suppressed"] = record.suppressed
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        """Merge the arguments into the message and render any traceback to
+        exc_text, both while they are still valid; unlike the stdlib version
+        the traceback stays out of the message so formatters can place it"""
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = (self.formatter or logging.Formatter()).formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def add_log_context(record):
+    """Fill in the device fields every formatter expects; always keeps the record"""
+    if not hasattr(record, "device"):
+        record.device = None
+        record.device_name = None
+    record.device_tag = f"[{record.device_name}] " if record.device_name else ""
+    record.suppressed = 0
+    record.suppressed_note = ""
+    return True
+
+
+def rate_limit_log(record):
+    """Drop repeats of the same DEBUG or INFO message template from the same
+    device beyond LOG_RATE_LIMIT per LOG_RATE_WINDOW seconds. Warnings and
+    errors always get through.
+
+    Keyed on the unformatted message, so lazily formatted lines ("%s at %s")
+    share one budget however many punches they describe.
+    """
+    if LOG_RATE_LIMIT <= 0 or record.levelno >= logging.WARNING:
+        return True
+    key = (record.msg, record.device)
+    now = time.monotonic()
+    with log_rate_lock:
+        state = log_rate_state.get(key)
+        if state is None or now - state[0] >= LOG_RATE_WINDOW:
+            if state is None and len(log_rate_state) >= LOG_RATE_KEYS:
+                log_rate_state.clear()
+            suppressed = state[2] if state else 0
+            log_rate_state[key] = [now, 1, 0]
+            if suppressed:
+                record.suppressed = suppressed
+                record.suppressed_note = f" ({suppressed} similar lines suppressed)"
+            return True
+        if state[1] < LOG_RATE_LIMIT:
+            state[1] += 1
+            return True
+        state[2] += 1
+        return False
+
+
+def configure_logging():
+    """Route the "listener" logger through a queue to a console writer thread.
+
+    The calling thread filters records (level, rate limit) and merges the
+    message arguments and any traceback into text, as arguments may change
+    once the call returns; laying out the line and the write to stdout
+    happen on the writer thread.
+    """
+    global log_listener
+    if log_listener is not None:
+        return
+    stream = sys.stdout
+    # Keep Arabic names readable in PM2 logs whatever the host's locale
+    if (getattr(stream, "encoding", None) or "").lower().replace("-", "") != "utf8" and hasattr(stream, "reconfigure"):
+        try:
+            stream.reconfigure(encoding="utf-8", errors="replace")
+        except Exception:
+            pass
+    handler = logging.StreamHandler(stream)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)-7s %(device_tag)s%(message)s%(suppressed_note)s",
+            "%Y-%m-%d %H:%M:%S"
+        ))
+    
+    log_queue = queue.SimpleQueue()
+    log.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    log.propagate = False
+    log.addFilter(add_log_context)
+    log.addFilter(rate_limit_log)
+    log.addHandler(LogQueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener.start()
+    # Flush whatever is still queued when the process exits
+    atexit.register(log_listener.stop)
+
+
+def device_log(device):
+    """Logger that tags every line with the device's id and name"""
+    return logging.LoggerAdapter(log, {"device": device["id"], "device_name": device["name"]})
+
 
-# Safe print function that handles Unicode characters
 def safe_print(*args, **kwargs):
-    """Print function that safely handles Unicode characters"""
-    try:
-        # Convert all arguments to strings and handle Unicode
-        safe_args = []
-        for arg in args:
-            if isinstance(arg, str):
-                # Replace problematic Unicode characters with safe alternatives
-                safe_arg = arg.encode('ascii', 'replace').decode('ascii')
-                safe_args.append(safe_arg)
-            else:
-                safe_args.append(str(arg))
-        print(*safe_args, **kwargs)
-    except Exception as e:
-        # Fallback: print without Unicode characters
-        print("Print error:", str(e))
-        print(*[str(arg).encode('ascii', 'replace').decode('ascii') for arg in args], **kwargs)
+    """Log the arguments as one INFO line; Unicode is passed through unchanged"""
+    log.info(" ".join(str(arg) for arg in args))
+
+
+configure_logging()
 
 # Function to clean user input data
 def clean_user_input(text):
@@ -96,92 +460,985 @@ def clean_user_input(text):
         has_non_latin = any(ord(char) > 127 for char in cleaned)
         
         if has_non_latin:
-            safe_print(f"⚠️  Name contains non-Latin characters: '{cleaned}'")
+            log.debug("Name contains non-Latin characters: '%s'", cleaned)
             # The text will be sent as-is (UTF-8) and let the device handle it
             # The device should support UTF-8, but display may vary
             
         return cleaned
     except Exception as e:
-        safe_print(f"Error cleaning user input: {e}")
+        log.warning("Error cleaning user input: %s", e)
         return ""
 
 
-def send_to_node(user_id, timestamp, device_ip=None):
+def init_outbox():
+    """Open the on-disk outbox, creating it on first run"""
+    global outbox_db
+    with outbox_lock:
+        if outbox_db is not None:
+            return
+        outbox_db = sqlite3.connect(OUTBOX_FILE, check_same_thread=False, isolation_level=None)
+        outbox_db.execute("PRAGMA journal_mode=WAL")
+        outbox_db.execute("PRAGMA synchronous=NORMAL")
+        outbox_db.execute(
+            """CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT
+            )"""
+        )
+        # Outboxes from before backfill mode lack these; their rows count as live
+        columns = {row[1] for row in outbox_db.execute("PRAGMA table_info(outbox)")}
+        if "priority" not in columns:
+            outbox_db.execute("ALTER TABLE outbox ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+        if "device_id" not in columns:
+            outbox_db.execute("ALTER TABLE outbox ADD COLUMN device_id TEXT")
+        outbox_db.execute("CREATE INDEX IF NOT EXISTS outbox_order ON outbox (priority, id)")
+
+
+def enqueue_attendance(payload):
+    """Durably append one punch to the outbox and wake the sender"""
+    init_outbox()
+    with outbox_lock:
+        outbox_db.execute(
+            "INSERT INTO outbox (payload, created_at) VALUES (?, ?)",
+            (json.dumps(payload, ensure_ascii=False), datetime.now().isoformat())
+        )
+    outbox_wakeup.set()
+
+
+def enqueue_backlog(device_id, payloads):
+    """Append a device's catch-up punches to the outbox in one transaction"""
+    init_outbox()
+    created_at = datetime.now().isoformat()
+    with outbox_lock:
+        outbox_db.execute("BEGIN")
+        counted = False
+        try:
+            outbox_db.executemany(
+                "INSERT INTO outbox (payload, created_at, priority, device_id) VALUES (?, ?, 1, ?)",
+                [(json.dumps(payload, ensure_ascii=False), created_at, device_id) for payload in payloads]
+            )
+            # Counted before the rows become visible, so the sender can never
+            # report them delivered ahead of them being queued
+            update_backfill_progress(device_id, queued=len(payloads), publish=False)
+            counted = True
+            outbox_db.execute("COMMIT")
+        except Exception:
+            if outbox_db.in_transaction:
+                outbox_db.execute("ROLLBACK")
+            if counted:
+                update_backfill_progress(device_id, queued=-len(payloads), publish=False)
+            raise
+    publish_device_state(device_id)
+    outbox_wakeup.set()
+
+
+def fetch_outbox_batch(limit=OUTBOX_FETCH_SIZE, backlog=False):
+    """Oldest queued live punches, or with backlog set the oldest catch-up ones"""
+    with outbox_lock:
+        rows = outbox_db.execute(
+            "SELECT id, payload, device_id FROM outbox WHERE priority = ? ORDER BY id LIMIT ?",
+            (1 if backlog else 0, limit)
+        ).fetchall()
+    if backlog:
+        return [(row_id, json.loads(payload), device_id) for row_id, payload, device_id in rows]
+    return [(row_id, json.loads(payload)) for row_id, payload, _ in rows]
+
+
+def pending_backlog():
+    """Catch-up punches still queued, per device id"""
+    init_outbox()
+    with outbox_lock:
+        rows = outbox_db.execute(
+            "SELECT device_id, COUNT(*) FROM outbox WHERE priority = 1 GROUP BY device_id"
+        ).fetchall()
+    return dict(rows)
+
+
+def update_backfill_progress(device_id, queued=0, delivered=0, publish=True):
+    """Fold queued or delivered catch-up punches into the device's listen entry.
+
+    A device's progress restarts from zero when a new backlog arrives after
+    the previous one finished.
+    """
+    if device_id not in devices:
+        return
+    now = datetime.now().isoformat()
+    with registry_lock:
+        entry = listen_status["devices"].get(device_id) or {}
+        progress = entry.get("backfill")
+        if progress is None or (queued > 0 and progress["state"] == "done"):
+            progress = {"state": "draining", "queued": 0, "delivered": 0, "started_at": now, "finished_at": None}
+        progress = dict(progress, queued=progress["queued"] + queued, delivered=progress["delivered"] + delivered)
+        pending = max(progress["queued"] - progress["delivered"], 0)
+        progress["pending"] = pending
+        progress["eta_seconds"] = round(pending / BACKFILL_RATE, 1) if BACKFILL_RATE > 0 else None
+        if pending == 0:
+            progress.update(state="done", finished_at=now)
+        update_listen_entry(device_id, create=True, backfill=progress)
+    if publish:
+        publish_device_state(device_id)
+
+
+def delete_outbox_rows(row_ids):
+    with outbox_lock:
+        outbox_db.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in row_ids])
+
+
+def mark_outbox_failure(row_ids, error):
+    with outbox_lock:
+        outbox_db.executemany(
+            "UPDATE outbox SET attempts = attempts + 1, last_error = ? WHERE id = ?",
+            [(str(error), row_id) for row_id in row_ids]
+        )
+
+
+def outbox_depth():
+    init_outbox()
+    with outbox_lock:
+        return outbox_db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+
+def init_history():
+    """Open the attendance history store, creating it on first run"""
+    global history_db
+    with history_lock:
+        if history_db is not None:
+            return
+        db = sqlite3.connect(HISTORY_FILE, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            """CREATE TABLE IF NOT EXISTS attendance (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id TEXT NOT NULL,
+                device_name TEXT,
+                device_ip TEXT,
+                user_id TEXT NOT NULL,
+                punch_time TEXT NOT NULL,
+                status INTEGER,
+                punch INTEGER,
+                recorded_at TEXT NOT NULL
+            )"""
+        )
+        # Also keeps a punch that is read twice (after a reconnect) from being stored twice
+        db.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS attendance_device_time "
+            "ON attendance (device_id, punch_time, user_id)"
+        )
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS attendance_user_time ON attendance (user_id, punch_time)"
+        )
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS attendance_time ON attendance (punch_time)"
+        )
+        # Published only once the schema is in place, so a failed open is retried
+        history_db = db
+
+
+def record_attendance(device, records):
+    """Store device punches in the history in one transaction; repeats are ignored.
+    Errors are logged, never raised, so delivery to Node goes ahead regardless."""
+    if not records:
+        return
+    recorded_at = datetime.now().isoformat()
+    rows = [
+        (
+            device["id"], device["name"], device["ip"], str(att.user_id),
+            format_punch_time(att.timestamp), getattr(att, "status", None),
+            getattr(att, "punch", None), recorded_at
+        )
+        for att in records
+    ]
+    # History is for reports; no failure here, opening the store included,
+    # may hold up delivery
     try:
-        payload = {"userId": str(user_id), "time": timestamp, "deviceIp": device_ip}
-        requests.post(NODE_API, json=payload, timeout=3)
-        safe_print(f"Sent {payload}")
+        init_history()
+        with history_lock:
+            history_db.execute("BEGIN")
+            try:
+                history_db.executemany(
+                    "INSERT OR IGNORE INTO attendance "
+                    "(device_id, device_name, device_ip, user_id, punch_time, status, punch, recorded_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                history_db.execute("COMMIT")
+            except Exception:
+                if history_db.in_transaction:
+                    history_db.execute("ROLLBACK")
+                raise
     except Exception as error:
-        safe_print("Error sending:", error)
+        device_log(device).error("Could not store %d punches in history: %s", len(rows), error)
+
+
+def parse_history_time(value, end_of_day=False):
+    """Accept "YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS"; a bare date as an upper
+    bound covers the whole day. Raises ValueError on anything else."""
+    value = value.strip().replace("T", " ")
+    if len(value) == 10:
+        datetime.strptime(value, "%Y-%m-%d")
+        return value + (" 23:59:59" if end_of_day else " 00:00:00")
+    return format_punch_time(datetime.strptime(value, "%Y-%m-%d %H:%M:%S"))
+
+
+def history_filters(args):
+    """WHERE clause and parameters for the from/to/userId/deviceId query arguments"""
+    clauses, params = [], []
+    if args.get("from"):
+        clauses.append("punch_time >= ?")
+        params.append(parse_history_time(args["from"]))
+    if args.get("to"):
+        clauses.append("punch_time <= ?")
+        params.append(parse_history_time(args["to"], end_of_day=True))
+    if args.get("userId"):
+        clauses.append("user_id = ?")
+        params.append(str(args["userId"]))
+    if args.get("deviceId"):
+        clauses.append("device_id = ?")
+        params.append(str(args["deviceId"]))
+    return clauses, params
+
+
+def history_page_size(args):
+    limit = int(args.get("limit", HISTORY_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return min(limit, HISTORY_MAX_PAGE_SIZE)
+
+
+def query_attendance(args):
+    """One page of stored punches in time order, plus the cursor for the next.
+
+    Paging is keyset-based on (punch_time, id), so deep pages cost the same
+    as the first and rows inserted meanwhile never shift a page.
+    """
+    clauses, params = history_filters(args)
+    limit = history_page_size(args)
+    descending = args.get("order", "asc").lower() == "desc"
+    if args.get("cursor"):
+        cursor_time, _, cursor_id = args["cursor"].rpartition("|")
+        comparison = "<" if descending else ">"
+        clauses.append(f"(punch_time {comparison} ? OR (punch_time = ? AND id {comparison} ?))")
+        params.extend([cursor_time, cursor_time, int(cursor_id)])
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    direction = "DESC" if descending else "ASC"
+    init_history()
+    with history_lock:
+        rows = history_db.execute(
+            "SELECT id, device_id, device_name, device_ip, user_id, punch_time, status, punch "
+            f"FROM attendance {where} ORDER BY punch_time {direction}, id {direction} LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+    data = [
+        {
+            "id": row_id,
+            "deviceId": device_id,
+            "deviceName": device_name,
+            "deviceIp": device_ip,
+            "userId": user_id,
+            "time": punch_time,
+            "status": status,
+            "punch": punch,
+        }
+        for row_id, device_id, device_name, device_ip, user_id, punch_time, status, punch in rows[:limit]
+    ]
+    next_cursor = f"{data[-1]['time']}|{data[-1]['id']}" if len(rows) > limit else None
+    return data, next_cursor
+
+
+def query_daily_attendance(args):
+    """First and last punch per user per day, paged by (day, userId)"""
+    clauses, params = history_filters(args)
+    limit = history_page_size(args)
+    having = ""
+    having_params = []
+    if args.get("cursor"):
+        cursor_day, _, cursor_user = args["cursor"].partition("|")
+        having = "HAVING day > ? OR (day = ? AND user_id > ?)"
+        having_params = [cursor_day, cursor_day, cursor_user]
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    init_history()
+    with history_lock:
+        rows = history_db.execute(
+            "SELECT substr(punch_time, 1, 10) AS day, user_id, MIN(punch_time), MAX(punch_time), "
+            "COUNT(*), GROUP_CONCAT(DISTINCT device_id) "
+            f"FROM attendance {where} GROUP BY day, user_id {having} ORDER BY day, user_id LIMIT ?",
+            params + having_params + [limit + 1]
+        ).fetchall()
+    data = [
+        {
+            "date": day,
+            "userId": user_id,
+            "firstPunch": first_punch,
+            "lastPunch": last_punch,
+            "punches": punches,
+            "deviceIds": device_ids.split(",") if device_ids else [],
+        }
+        for day, user_id, first_punch, last_punch, punches, device_ids in rows[:limit]
+    ]
+    next_cursor = f"{data[-1]['date']}|{data[-1]['userId']}" if len(rows) > limit else None
+    return data, next_cursor
 
 
-def scan_network_for_devices(network_range="192.168.1", port=4370, timeout=2):
-    """Scan network for fingerprint devices"""
-    devices_found = []
+def metric_key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc_counter(name, amount=1, **labels):
+    key = metric_key(name, labels)
+    with metrics_lock:
+        metric_values[key] = metric_values.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    """Record one histogram observation"""
+    buckets = METRICS[name][2]
+    key = metric_key(name, labels)
+    with metrics_lock:
+        series = metric_values.get(key)
+        if series is None:
+            series = metric_values[key] = [[0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    with metrics_lock:
+        snapshot = {
+            key: ([list(value[0]), value[1], value[2]] if isinstance(value, list) else value)
+            for key, value in metric_values.items()
+        }
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (metric, labels), value in sorted(snapshot.items()):
+            if metric != name:
+                continue
+            if kind == "counter":
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            counts, total, count = value
+            for bound, bucket_count in zip(buckets, counts):
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {bucket_count}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
     
-    def check_device(ip):
+    # Gauges are read from live state at scrape time
+    gauges = [
+        ("device_info", "Configured devices (always 1)", [
+            ((("device", device_id), ("ip", device["ip"]), ("name", device["name"])), 1)
+            for device_id, device in devices.items()
+        ]),
+        ("listener_running", "Whether the device's listener is connected", [
+            ((("device", device_id),), int(bool(entry.get("running"))))
+            for device_id, entry in listen_status["devices"].items()
+        ]),
+        ("device_breaker_open", "Whether the device's circuit breaker is open", [
+            ((("device", device_id),), int(entry.get("breaker") == "open"))
+            for device_id, entry in listen_status["devices"].items()
+        ]),
+        ("dashboard_subscribers", "Open /api/events streams", [((), len(event_subscribers))]),
+    ]
+    try:
+        gauges.append(("outbox_pending", "Punches waiting for delivery to Node", [((), outbox_depth())]))
+    except Exception:
+        pass
+    for name, help_text, samples in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def publish_event(event, data):
+    """Push an event to every connected dashboard without ever blocking the caller"""
+    try:
+        message = sse_event(event, data)
+    except Exception as error:
+        log.warning("Could not publish %s event: %s", event, error)
+        return
+    with event_subscribers_lock:
+        subscribers = list(event_subscribers)
+    for subscriber in subscribers:
         try:
-            zk = ZK(ip, port=port, timeout=timeout)
-            conn = zk.connect()
-            if conn:
-                info = {
-                    "ip": ip,
-                    "port": port,
-                    "platform": conn.get_platform(),
-                    "firmwareVersion": conn.get_firmware_version(),
-                    "serialNumber": conn.get_serialnumber(),
-                    "status": "online"
-                }
-                conn.disconnect()
-                return info
-        except Exception:
-            pass
-        return None
+            subscriber.put_nowait(message)
+        except queue.Full:
+            # A stalled tab: drop its backlog and resync it with a snapshot.
+            # Other publishers may refill the queue in between; try again a
+            # few times rather than let queue.Full reach a listener thread
+            for _ in range(3):
+                while True:
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        break
+                try:
+                    subscriber.put_nowait(None)
+                    break
+                except queue.Full:
+                    continue
+
+
+def listen_status_snapshot():
+    """Listening status as served by /api/listen/status"""
+    return dict(listen_status, outbox={"pending": outbox_depth()})
+
+
+def publish_device_state(device_id):
+    """Push one device's configuration and listener state to dashboards"""
+    publish_event("device", {
+        "id": device_id,
+        "device": devices.get(device_id),
+        "listen": listen_status["devices"].get(device_id),
+    })
+
+
+def publish_listen_status():
+    publish_event("status", listen_status_snapshot())
+
+
+def send_to_node(user_id, timestamp, device_ip=None):
+    """Queue a punch for delivery to Node; never blocks on HTTP"""
+    payload = {"userId": str(user_id), "time": timestamp, "deviceIp": device_ip}
+    enqueue_attendance(payload)
+    publish_event("punch", payload)
+
+
+def get_node_session():
+    """Return the shared keep-alive session for Node, creating it on first use"""
+    global node_session
+    with node_session_lock:
+        if node_session is None:
+            # Retry refused connections and gateway errors only; a read timeout
+            # may mean Node already stored the punch, so the outbox retries that
+            retry = Retry(
+                total=NODE_RETRIES,
+                connect=NODE_RETRIES,
+                read=0,
+                status=NODE_RETRIES,
+                backoff_factor=NODE_RETRY_BACKOFF,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset({"POST"}),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=NODE_POOL_SIZE,
+                pool_maxsize=NODE_POOL_SIZE,
+                max_retries=retry
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            node_session = session
+        return node_session
+
+
+def deliver_to_node(payload):
+    """POST one punch to Node, raising if it was not accepted"""
+    response = get_node_session().post(
+        NODE_API, json=payload, timeout=(NODE_CONNECT_TIMEOUT, NODE_READ_TIMEOUT)
+    )
+    response.raise_for_status()
+    log.debug("Sent %s", payload)
+
+
+def deliver_batch_to_node(payloads):
+    """POST a list of punches to Node's bulk endpoint, raising if it was not accepted"""
+    response = get_node_session().post(
+        NODE_BULK_API, json=payloads, timeout=(NODE_CONNECT_TIMEOUT, NODE_READ_TIMEOUT * 3)
+    )
+    response.raise_for_status()
+    log.debug("Sent batch of %d punches", len(payloads))
+
+
+def deliver_backlog_batch(rows):
+    """Send one batch of catch-up punches and record each device's progress"""
+    delivery_started = time.perf_counter()
+    deliver_batch_to_node([payload for _, payload, _ in rows])
+    observe("node_delivery_duration_seconds", time.perf_counter() - delivery_started, mode="backfill")
+    inc_counter("node_delivered_punches_total", len(rows))
+    delete_outbox_rows([row_id for row_id, _, _ in rows])
+    per_device = {}
+    for _, _, device_id in rows:
+        per_device[device_id] = per_device.get(device_id, 0) + 1
+    for device_id, count in per_device.items():
+        update_backfill_progress(device_id, delivered=count)
+
+
+def outbox_sender_loop():
+    """Drain the outbox in order, keeping undelivered punches until Node accepts them.
+
+    Live punches always go first. Catch-up backlog is only sent when no live
+    punch is queued, in bulk batches paced to BACKFILL_RATE; a live punch
+    arriving during the pause is delivered straight away.
+    """
+    retry_delay = OUTBOX_RETRY_MIN_DELAY
+    fetch_size = NODE_BATCH_SIZE if NODE_BATCH_MODE else OUTBOX_FETCH_SIZE
+    next_backfill_at = 0
+    while not outbox_stop_event.is_set():
+        try:
+            rows = fetch_outbox_batch(fetch_size)
+            if rows and NODE_BATCH_MODE and len(rows) < NODE_BATCH_SIZE and NODE_BATCH_WINDOW > 0:
+                # Give a burst the rest of the window to fill the batch
+                outbox_stop_event.wait(NODE_BATCH_WINDOW)
+                rows = fetch_outbox_batch(fetch_size)
+            backlog = [] if rows else fetch_outbox_batch(BACKFILL_BATCH_SIZE, backlog=True)
+        except Exception as error:
+            log.error("Error reading outbox: %s", error)
+            outbox_stop_event.wait(retry_delay)
+            continue
+        if backlog:
+            pause = next_backfill_at - time.monotonic()
+            if pause > 0:
+                # Wakes early when a live punch is queued
+                outbox_wakeup.wait(timeout=pause)
+                outbox_wakeup.clear()
+                continue
+            try:
+                deliver_backlog_batch(backlog)
+            except Exception as error:
+                inc_counter("node_delivery_failures_total", mode="backfill")
+                log.warning("Error sending backlog (will retry in %ss): %s", retry_delay, error)
+                try:
+                    mark_outbox_failure([row_id for row_id, _, _ in backlog], error)
+                except Exception:
+                    pass
+                outbox_stop_event.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, OUTBOX_RETRY_MAX_DELAY)
+                continue
+            retry_delay = OUTBOX_RETRY_MIN_DELAY
+            if BACKFILL_RATE > 0:
+                next_backfill_at = time.monotonic() + len(backlog) / BACKFILL_RATE
+            continue
+        if not rows:
+            outbox_wakeup.wait(timeout=1)
+            outbox_wakeup.clear()
+            continue
+        batches = [rows] if NODE_BATCH_MODE else [[row] for row in rows]
+        for batch in batches:
+            if outbox_stop_event.is_set():
+                break
+            row_ids = [row_id for row_id, _ in batch]
+            mode = "batch" if NODE_BATCH_MODE else "single"
+            delivery_started = time.perf_counter()
+            try:
+                if NODE_BATCH_MODE:
+                    deliver_batch_to_node([payload for _, payload in batch])
+                else:
+                    deliver_to_node(batch[0][1])
+                observe("node_delivery_duration_seconds", time.perf_counter() - delivery_started, mode=mode)
+                inc_counter("node_delivered_punches_total", len(batch))
+            except Exception as error:
+                inc_counter("node_delivery_failures_total", mode=mode)
+                log.warning("Error sending (will retry in %ss): %s", retry_delay, error)
+                try:
+                    mark_outbox_failure(row_ids, error)
+                except Exception:
+                    pass
+                # Keep delivery order: stop at the first failure and retry it
+                outbox_stop_event.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, OUTBOX_RETRY_MAX_DELAY)
+                break
+            delete_outbox_rows(row_ids)
+            retry_delay = OUTBOX_RETRY_MIN_DELAY
+
+
+def start_outbox_sender():
+    """Start the background thread that delivers queued punches to Node"""
+    global outbox_thread
+    init_outbox()
+    if outbox_thread is not None and outbox_thread.is_alive():
+        return
+    outbox_stop_event.clear()
+    outbox_thread = threading.Thread(target=outbox_sender_loop, daemon=True)
+    outbox_thread.start()
+    pending = outbox_depth()
+    if pending:
+        log.info("Outbox sender started with %d pending punches", pending)
+    # Backlog left over from before a restart is still reported per device
+    for device_id, count in pending_backlog().items():
+        update_backfill_progress(device_id, queued=count)
+
+
+def parse_scan_targets(network_range):
+    """Expand "192.168.1", CIDR ranges, single IPs or a comma-separated mix into host addresses"""
+    hosts = []
+    for part in str(network_range).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "/" not in part and part.count(".") == 2:
+            # Legacy form: the first three octets of a /24
+            part = f"{part}.0/24"
+        network = ipaddress.ip_network(part, strict=False)
+        if network.num_addresses > SCAN_MAX_HOSTS:
+            raise ValueError(f"Range {part} is larger than {SCAN_MAX_HOSTS} addresses")
+        if network.num_addresses == 1:
+            hosts.append(str(network.network_address))
+        else:
+            hosts.extend(str(host) for host in network.hosts())
+    hosts = list(dict.fromkeys(hosts))
+    if len(hosts) > SCAN_MAX_HOSTS:
+        raise ValueError(f"Scan covers more than {SCAN_MAX_HOSTS} addresses")
+    return hosts
+
+
+def fingerprint_device(ip, port=4370, timeout=SCAN_FINGERPRINT_TIMEOUT):
+    """Connect to a host with an open port and read its device info, or None if it is not a ZK device"""
+    try:
+        zk = ZK(ip, port=port, timeout=timeout)
+        conn = zk.connect()
+        if conn:
+            info = {
+                "ip": ip,
+                "port": port,
+                "platform": conn.get_platform(),
+                "firmwareVersion": conn.get_firmware_version(),
+                "serialNumber": conn.get_serialnumber(),
+                "status": "online"
+            }
+            conn.disconnect()
+            return info
+    except Exception:
+        pass
+    return None
+
+
+async def probe_port(ip, port, timeout):
+    """True if ip accepts a TCP connection on port within timeout"""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except Exception:
+        pass
+    return True
+
+
+async def scan_hosts(hosts, port, timeout, events, counts, cancel_event):
+    """Probe hosts with SCAN_CONCURRENCY workers and fingerprint responders as they turn up"""
+    loop = asyncio.get_running_loop()
+    pending = iter(hosts)
     
-    # Scan common IP range
-    with ThreadPoolExecutor(max_workers=50) as executor:
-        futures = []
-        for i in range(1, 255):
-            ip = f"{network_range}.{i}"
-            futures.append(executor.submit(check_device, ip))
+    with ThreadPoolExecutor(max_workers=SCAN_FINGERPRINT_WORKERS) as fingerprint_pool:
+        async def worker():
+            # All workers share one iterator, so each host is probed exactly once
+            for ip in pending:
+                if cancel_event.is_set():
+                    return
+                responding = await probe_port(ip, port, timeout)
+                counts["probed"] += 1
+                if not responding:
+                    continue
+                counts["responding"] += 1
+                info = await loop.run_in_executor(fingerprint_pool, fingerprint_device, ip, port)
+                if info:
+                    counts["found"] += 1
+                    events.put({"type": "device", "data": info})
         
-        for future in futures:
-            result = future.result()
-            if result:
-                devices_found.append(result)
+        await asyncio.gather(*(worker() for _ in range(max(1, min(SCAN_CONCURRENCY, len(hosts))))))
+
+
+def iter_network_scan(network_range, port=4370, timeout=SCAN_PROBE_TIMEOUT, cancel_event=None):
+    """Scan a range for devices, yielding events as they happen.
+
+    Yields {"type": "device", "data": info} for each device found,
+    {"type": "progress", ...counters} while the sweep runs and a final
+    {"type": "done", ...counters}. Setting cancel_event, or closing the
+    generator, stops the sweep.
+    """
+    hosts = parse_scan_targets(network_range)
+    cancel_event = cancel_event or threading.Event()
+    events = queue.Queue()
+    counts = {"total": len(hosts), "probed": 0, "responding": 0, "found": 0}
     
-    return devices_found
+    def run():
+        try:
+            asyncio.run(scan_hosts(hosts, port, timeout, events, counts, cancel_event))
+        except Exception as error:
+            events.put({"type": "error", "error": str(error)})
+        finally:
+            events.put(None)
+    
+    threading.Thread(target=run, daemon=True).start()
+    log.info("Scanning %d hosts on port %d", len(hosts), port)
+    last_progress = None
+    try:
+        while True:
+            try:
+                event = events.get(timeout=0.25)
+            except queue.Empty:
+                event = {}
+            if event is None:
+                break
+            if event:
+                yield event
+            progress = dict(counts)
+            if progress != last_progress:
+                last_progress = progress
+                yield {"type": "progress", **progress}
+        yield {"type": "done", "cancelled": cancel_event.is_set(), **counts}
+    finally:
+        cancel_event.set()
 
 
-def initialize_devices():
-    """Initialize device configurations"""
+def sse_event(event, data):
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def scan_network_for_devices(network_range="192.168.1", port=4370, timeout=SCAN_PROBE_TIMEOUT):
+    """Scan network for fingerprint devices"""
+    found = []
+    for event in iter_network_scan(network_range, port, timeout):
+        if event["type"] == "device":
+            found.append(event["data"])
+        elif event["type"] == "error":
+            log.error("Network scan of %s failed: %s", network_range, event["error"])
+    return found
+
+
+def put_device(device):
+    """Add or replace a device record"""
+    global devices
+    with registry_lock:
+        devices = {**devices, device["id"]: device}
+    return device
+
+
+def update_device(device_id, **fields):
+    """Swap in a copy of the device record with fields changed.
+
+    Returns the new record, or None if the device has been deleted.
+    """
     global devices
-    for i, device_config in enumerate(DEFAULT_DEVICES):
-        device_id = f"device_{i+1}"
-        devices[device_id] = {
-            "id": device_id,
-            "ip": device_config["ip"],
-            "port": device_config["port"],
-            "name": device_config["name"],
-            "enabled": device_config["enabled"],
-            "status": "unknown",
-            "info": {}
+    with registry_lock:
+        device = devices.get(device_id)
+        if device is None:
+            return None
+        if any(device.get(key) != value for key, value in fields.items()):
+            device = {**device, **fields}
+            devices = {**devices, device_id: device}
+        return device
+
+
+def remove_device(device_id):
+    """Drop a device with its listen status entry, thread and stop event; returns the removed record"""
+    global devices, listen_status, listen_threads, listen_stop_events
+    with registry_lock:
+        device = devices.get(device_id)
+        if device is None:
+            return None
+        devices = {key: value for key, value in devices.items() if key != device_id}
+        listen_status = dict(listen_status, devices={
+            key: value for key, value in listen_status["devices"].items() if key != device_id
+        })
+        listen_threads = {key: value for key, value in listen_threads.items() if key != device_id}
+        listen_stop_events = {key: value for key, value in listen_stop_events.items() if key != device_id}
+        return device
+
+
+def update_listen_status(**fields):
+    global listen_status
+    with registry_lock:
+        listen_status = dict(listen_status, **fields)
+
+
+def update_listen_entry(device_id, create=False, **fields):
+    """Swap in a copy of a device's listen status entry with fields changed.
+
+    Missing entries are only created when create is set, so a listener that
+    finishes after its device was deleted does not bring the entry back.
+    """
+    global listen_status
+    with registry_lock:
+        entry = listen_status["devices"].get(device_id)
+        if entry is None and not create:
+            return None
+        entry = {**(entry or {}), **fields}
+        listen_status = dict(listen_status, devices={**listen_status["devices"], device_id: entry})
+        return entry
+
+
+def device_config(device):
+    """The persisted part of a device record"""
+    return {key: device[key] for key in DEVICE_CONFIG_FIELDS}
+
+
+def new_device_record(config):
+    return {**config, "status": "unknown", "connected": False, "info": {}}
+
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def read_device_store():
+    """Parse DEVICES_FILE into ({device_id: config}, next_id)"""
+    with open(DEVICES_FILE, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    configs = {}
+    for entry in data.get("devices", []):
+        config = {
+            "id": str(entry["id"]),
+            "name": entry.get("name") or str(entry["id"]),
+            "ip": entry["ip"],
+            "port": int(entry.get("port", 4370)),
+            "enabled": bool(entry.get("enabled", True)),
         }
+        configs[config["id"]] = config
+    # Never hand out an ID that is already in the file, even if next_id was edited down
+    numbers = [int(device_id[7:]) for device_id in configs if device_id.startswith("device_") and device_id[7:].isdigit()]
+    return configs, max([int(data.get("next_id", 1))] + [n + 1 for n in numbers])
+
+
+def save_device_store():
+    """Atomically persist the device configuration"""
+    global device_store_signature
+    with registry_lock:
+        data = {"next_id": device_store_next_id, "devices": [device_config(d) for d in devices.values()]}
+        tmp_path = f"{DEVICES_FILE}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, DEVICES_FILE)
+        device_store_signature = file_signature(DEVICES_FILE)
+
+
+def allocate_device_id():
+    global device_store_next_id
+    with registry_lock:
+        while f"device_{device_store_next_id}" in devices:
+            device_store_next_id += 1
+        device_id = f"device_{device_store_next_id}"
+        device_store_next_id += 1
+        return device_id
 
 
-def connect_once(device_ip=None, device_port=None):
-    """Connect to a specific device or default device"""
-    if device_ip and device_port:
-        zk = ZK(device_ip, port=device_port, timeout=5)
+def initialize_devices():
+    """Load device configurations, seeding DEVICES_FILE from DEFAULT_DEVICES on first run"""
+    global device_store_next_id, device_store_signature
+    if os.path.exists(DEVICES_FILE):
+        configs, next_id = read_device_store()
+        device_store_signature = file_signature(DEVICES_FILE)
+        seeded = False
     else:
-        # Use first enabled device as default
-        for device in devices.values():
-            if device["enabled"]:
-                zk = ZK(device["ip"], port=device["port"], timeout=5)
-                break
-        else:
-            raise Exception("No enabled devices found")
-    return zk.connect()
+        configs = {}
+        for i, default in enumerate(DEFAULT_DEVICES):
+            device_id = f"device_{i+1}"
+            configs[device_id] = {
+                "id": device_id,
+                "name": default["name"],
+                "ip": default["ip"],
+                "port": default["port"],
+                "enabled": default["enabled"],
+            }
+        next_id = len(configs) + 1
+        seeded = True
+    
+    for config in configs.values():
+        put_device(new_device_record(config))
+    device_store_next_id = next_id
+    if seeded:
+        save_device_store()
+
+
+def apply_device_config(device_id, config):
+    """Bring one device in line with its configuration (None deletes it).
+
+    Only this device's session, user cache and listener are touched: a
+    new or re-enabled device gets a listener if listening is on, a new
+    address restarts it and disabling or deleting stops it.
+    """
+    old = devices.get(device_id)
+    if config is None:
+        if old is None:
+            return
+        stop_device_listener(device_id)
+        remove_device(device_id)
+        close_device_session(device_id)
+        invalidate_user_directory(device_id)
+        publish_event("device_removed", {"id": device_id})
+        return
+    
+    if old is None:
+        put_device(new_device_record(config))
+    elif device_config(old) == config:
+        return
+    else:
+        update_device(device_id, **config)
+    
+    address_changed = old is not None and (old["ip"], old["port"]) != (config["ip"], config["port"])
+    if address_changed or not config["enabled"]:
+        close_device_session(device_id)
+        invalidate_user_directory(device_id)
+    if not config["enabled"]:
+        stop_device_listener(device_id)
+    elif listen_status["running"] and (old is None or not old["enabled"] or address_changed):
+        # Other edits (a rename) leave a listener stopped through the API stopped
+        start_device_listener(device_id)
+    publish_device_state(device_id)
+
+
+def reload_device_store():
+    """Apply DEVICES_FILE after it was changed outside the API"""
+    global device_store_next_id, device_store_signature
+    with registry_lock:
+        signature = file_signature(DEVICES_FILE)
+        configs, next_id = read_device_store()
+        device_store_signature = signature
+        device_store_next_id = max(device_store_next_id, next_id)
+        current_ids = list(devices)
+    log.info("Reloading device configuration from %s", DEVICES_FILE)
+    for device_id in current_ids:
+        if device_id not in configs:
+            apply_device_config(device_id, None)
+    for device_id, config in configs.items():
+        apply_device_config(device_id, config)
+
+
+def watch_device_store():
+    """Poll DEVICES_FILE and hot-reload it when it changes"""
+    global device_store_signature
+    while True:
+        time.sleep(DEVICES_WATCH_INTERVAL)
+        signature = file_signature(DEVICES_FILE)
+        if signature is None or signature == device_store_signature:
+            continue
+        try:
+            reload_device_store()
+        except Exception as error:
+            # Half-written or invalid: keep the running config and wait for the next edit
+            log.warning("Ignoring unreadable device file %s: %s", DEVICES_FILE, error)
+            device_store_signature = signature
 
 
 def validate_device_connectivity(device_ip, device_port, timeout=3):
@@ -197,49 +1454,162 @@ def validate_device_connectivity(device_ip, device_port, timeout=3):
         return False
 
 
-def connect_with_retry(device_ip, device_port, max_retries=3, retry_delay=5):
-    """Connect to device with retry mechanism"""
-    for attempt in range(max_retries):
-        try:
-            if not validate_device_connectivity(device_ip, device_port):
-                if attempt < max_retries - 1:
-                    print(f"Device {device_ip}:{device_port} not reachable, retrying in {retry_delay}s... (attempt {attempt + 1}/{max_retries})")
-                    time.sleep(retry_delay)
-                    continue
-                else:
-                    raise Exception(f"Device {device_ip}:{device_port} not reachable after {max_retries} attempts")
-            
-            zk = ZK(device_ip, port=device_port, timeout=5)
-            conn = zk.connect()
-            return conn
-        except Exception as e:
-            if attempt < max_retries - 1:
-                print(f"Connection attempt {attempt + 1}/{max_retries} failed: {e}, retrying in {retry_delay}s...")
-                time.sleep(retry_delay)
-            else:
-                raise e
-
-
 def connect_to_device(device_id):
-    """Connect to a specific device by ID"""
-    if device_id not in devices:
+    """Open a new ZK connection to a specific device by ID"""
+    device = devices.get(device_id)
+    if device is None:
         raise Exception(f"Device {device_id} not found")
-    
-    device = devices[device_id]
     if not device["enabled"]:
         raise Exception(f"Device {device_id} is disabled")
     
     # Validate connectivity before attempting ZK connection
     if not validate_device_connectivity(device["ip"], device["port"]):
-        device["status"] = "offline"
-        raise Exception(f"Device {device['name']} ({device['ip']}:{device['port']}) is not reachable on the network")
+        if device.get("status") != "offline":
+            update_device(device_id, status="offline")
+            publish_device_state(device_id)
+        raise ZKNetworkError(f"Device {device['name']} ({device['ip']}:{device['port']}) is not reachable on the network")
     
     zk = ZK(device["ip"], port=device["port"], timeout=5)
+    connect_started = time.perf_counter()
     conn = zk.connect()
-    device["status"] = "online"
+    observe("zk_connect_duration_seconds", time.perf_counter() - connect_started, device=device_id)
+    if device.get("status") not in ("listening", "online"):
+        device = update_device(device_id, status="online") or device
+        publish_device_state(device_id)
     return conn, device
 
 
+def default_device_id():
+    """ID of the first enabled device, used when a request does not name one"""
+    for device_id, device in devices.items():
+        if device["enabled"]:
+            return device_id
+    raise Exception("No enabled devices found")
+
+
+def get_device_session(device_id):
+    """Return the shared session record for a device, creating it if needed"""
+    with device_sessions_lock:
+        session = device_sessions.get(device_id)
+        if session is None:
+            session = {
+                "cond": threading.Condition(),
+                "held": False,
+                "queue": [],  # heap of (priority, sequence) tickets waiting for a turn
+                "conn": None,
+                "last_used": 0.0,
+                "stale": False
+            }
+            device_sessions[device_id] = session
+        return session
+
+
+def drop_session_connection(session):
+    conn, session["conn"] = session["conn"], None
+    session["stale"] = False
+    if conn:
+        try:
+            conn.disconnect()
+        except Exception:
+            pass
+
+
+def acquire_device_turn(session, device, priority, timeout):
+    """Queue for the device and block until this caller is first in line
+    (timeout=None waits as long as it takes)"""
+    ticket = (priority, next(lease_sequence))
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with session["cond"]:
+        heapq.heappush(session["queue"], ticket)
+        while session["held"] or session["queue"][0] != ticket:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                session["queue"].remove(ticket)
+                heapq.heapify(session["queue"])
+                session["cond"].notify_all()
+                raise Exception(f"Device {device['name']} is busy, try again shortly")
+            session["cond"].wait(remaining)
+        heapq.heappop(session["queue"])
+        session["held"] = True
+
+
+def release_device_turn(session):
+    with session["cond"]:
+        session["held"] = False
+        session["cond"].notify_all()
+
+
+@contextmanager
+def lease_device(device_id, priority=PRIORITY_ADMIN, timeout=SESSION_LEASE_TIMEOUT):
+    """Exclusive use of the device's shared, already authenticated ZK session.
+
+    Every caller queues on the device and runs its commands in turn, lowest
+    priority value first and in arrival order within a priority, so user
+    writes overtake routine polling and nothing talks to a terminal while
+    another command is in flight. Idle sessions are health-checked before
+    they are handed out and broken ones are reopened, so callers never pay
+    for a handshake on a warm device.
+    """
+    device = devices.get(device_id)
+    if device is None:
+        raise Exception(f"Device {device_id} not found")
+    if not device["enabled"]:
+        raise Exception(f"Device {device_id} is disabled")
+    if breaker_open(device_id):
+        # Fail fast instead of every request paying a connect timeout
+        raise ZKNetworkError(f"Device {device['name']} is offline, waiting for it to come back")
+    
+    session = get_device_session(device_id)
+    acquire_device_turn(session, device, priority, timeout)
+    try:
+        if session["stale"]:
+            drop_session_connection(session)
+        conn = session["conn"]
+        if conn is not None and time.monotonic() - session["last_used"] > SESSION_HEALTHCHECK_AFTER:
+            try:
+                conn.get_time()
+            except Exception:
+                device_log(device).info("Idle session expired, reconnecting")
+                drop_session_connection(session)
+                conn = None
+        if conn is None:
+            conn, _ = connect_to_device(device_id)
+            session["conn"] = conn
+        try:
+            yield conn, device
+        except ZKErrorResponse:
+            # The device refused a command but the session itself is fine
+            raise
+        except Exception:
+            drop_session_connection(session)
+            raise
+        finally:
+            session["last_used"] = time.monotonic()
+    finally:
+        if session["stale"]:
+            drop_session_connection(session)
+        release_device_turn(session)
+
+
+def device_lease_contended(device_id):
+    """Whether any command is queued behind the current holder of the device"""
+    return bool(get_device_session(device_id)["queue"])
+
+
+def close_device_session(device_id):
+    """Drop a device's session, now if it is free or as soon as its holder releases it"""
+    session = get_device_session(device_id)
+    with session["cond"]:
+        if session["held"]:
+            session["stale"] = True
+            return
+        session["held"] = True
+    try:
+        drop_session_connection(session)
+    finally:
+        release_device_turn(session)
+
+
 def pick_next_uid(existing_users):
     try:
         uid_values = []
@@ -267,10 +1637,10 @@ def try_set_user_variants(conn, uid, user_id, name, privilege, password, enabled
                 # Force UTF-8 encoding cycle to ensure proper format
                 name = str(name)
         except Exception as enc_err:
-            safe_print(f"Name encoding warning: {enc_err}")
+            log.warning("Name encoding warning: %s", enc_err)
             name = str(name)
     
-    safe_print(f"Setting user with name: '{name}' (type: {type(name)}, length: {len(name) if name else 0})")
+    log.debug("Setting user with name: '%s' (length: %d)", name, len(name) if name else 0)
     
     # Most common signature for python-zk: set_user(uid=None, name='', privilege=const.USER_DEFAULT, password='', group_id='', user_id=None)
     variants = [
@@ -282,9 +1652,9 @@ def try_set_user_variants(conn, uid, user_id, name, privilege, password, enabled
     ]
     for i, kwargs in enumerate(variants):
         try:
-            safe_print(f"Trying variant {i+1}: {list(kwargs.keys())}")
+            log.debug("Trying variant %d: %s", i + 1, list(kwargs))
             conn.set_user(**kwargs)
-            safe_print(f"Successfully set user with variant {i+1}")
+            log.debug("Successfully set user with variant %d", i + 1)
             return True, None
         except TypeError as te:
             # Signature mismatch, try next
@@ -296,183 +1666,1072 @@ def try_set_user_variants(conn, uid, user_id, name, privilege, password, enabled
     return False, "; ".join(errors)
 
 
-def listen_loop_for_device(device_id):
+def parse_user_fields(body):
+    """Normalise the user fields of an enrolment request body"""
+    desired_user_id = clean_user_input(body.get("userId")) if body.get("userId") is not None else ""
+    
+    # Handle name with special care for Unicode
+    raw_name = body.get("name", "") or ""
+    log.debug("Raw name received: '%s'", raw_name)
+    
+    desired_name = clean_user_input(raw_name)
+    log.debug("Cleaned name: '%s' (length: %d)", desired_name, len(desired_name))
+    
+    if len(desired_name) > 24:
+        desired_name = desired_name[:24]
+        log.info("Name truncated to 24 chars: '%s'", desired_name)
+    
+    return {
+        "uid": int(body["uid"]) if body.get("uid") is not None else None,
+        "user_id": desired_user_id,
+        "name": desired_name,
+        "privilege": const.USER_DEFAULT if body.get("privilege") is None else int(body.get("privilege")),
+        "password": clean_user_input(body.get("password")) if body.get("password") else None,
+        "enabled": bool(body.get("enabled", True)),
+    }
+
+
+def choose_uid(fields, existing_users):
+    if fields["uid"] is not None:
+        return fields["uid"]
+    if fields["user_id"].isdigit():
+        return int(fields["user_id"])
+    return pick_next_uid(existing_users)
+
+
+def written_user(uid, fields):
+    """The User record a successful set_user leaves on the device"""
+    return User(uid, fields["name"], fields["privilege"], fields["password"] or "", "", fields["user_id"] or str(uid))
+
+
+@contextmanager
+def deferred_refresh(conn):
+    """Skip the refresh_data pyzk sends after every set_user and refresh once at the end"""
+    conn.refresh_data = lambda: True
+    try:
+        yield
+    finally:
+        del conn.refresh_data
+        try:
+            conn.refresh_data()
+        except Exception:
+            pass
+
+
+def enrol_users_on_device(device_id, entries, timeout):
+    """Write many users to one device inside a single disabled-device window.
+
+    entries are parse_user_fields() dicts, or {"userId", "error"} for bodies
+    that could not be parsed. Returns one result per entry, in order.
+    """
+    results = []
+    with lease_device(device_id, priority=PRIORITY_ENROL, timeout=timeout) as (conn, device):
+        # Users enrolled at the keypad since the directory was loaded hold uids too
+        directory = get_user_directory(device_id, conn, verify=True)
+        existing_users = list(directory["by_uid"].values())
+        written = []
+        device_log(device).info("[BULK] Enrolling %d users", len(entries))
+        try:
+            try:
+                conn.disable_device()
+            except Exception:
+                pass
+            with deferred_refresh(conn):
+                for fields in entries:
+                    if "error" in fields:
+                        results.append({"userId": fields["userId"], "ok": False, "error": fields["error"]})
+                        continue
+                    uid = choose_uid(fields, existing_users)
+                    ok, err = try_set_user_variants(
+                        conn, uid, fields["user_id"], fields["name"], fields["privilege"], fields["password"], fields["enabled"]
+                    )
+                    if ok:
+                        user = written_user(uid, fields)
+                        existing_users.append(user)
+                        written.append(user)
+                    results.append({"userId": fields["user_id"], "uid": uid, "ok": ok, "error": err})
+        finally:
+            update_user_directory(device_id, added=written)
+            try:
+                conn.enable_device()
+            except Exception:
+                pass
+    return results
+
+
+def serialize_user(u):
+    return {
+        "uid": int(getattr(u, "uid", u.user_id)) if hasattr(u, "user_id") else int(getattr(u, "uid", 0)),
+        "userId": str(u.user_id),
+        "name": u.name,
+        "privilege": int(u.privilege) if hasattr(u, "privilege") else None,
+        "enabled": bool(u.enabled) if hasattr(u, "enabled") else True,
+    }
+
+
+def index_users(users):
+    """Build a user directory indexed by uid, user_id and name"""
+    # unknown_uids: uids in the attendance log that a reload did not resolve
+    directory = {"by_uid": {}, "by_user_id": {}, "by_name": {}, "unknown_uids": set(), "loaded_at": time.monotonic()}
+    for u in users:
+        directory["by_uid"][str(u.uid)] = u
+        directory["by_user_id"].setdefault(str(u.user_id), u)
+        directory["by_name"].setdefault(str(u.name), u)
+    return directory
+
+
+def get_user_directory(device_id, conn, refresh=False, verify=False):
+    """Return the device's user directory, (re)loading it through conn when needed.
+
+    Must be called while holding the device lease. An expired directory is
+    kept if the device still reports the same number of users; verify runs
+    that check within the TTL too, for callers that allocate uids from it.
+    """
+    with user_directories_lock:
+        directory = user_directories.get(device_id)
+    if directory is not None and not refresh:
+        if not verify and time.monotonic() - directory["loaded_at"] < USER_CACHE_TTL:
+            return directory
+        conn.read_sizes()
+        if conn.users == len(directory["by_uid"]):
+            directory["loaded_at"] = time.monotonic()
+            return directory
+    directory = index_users(conn.get_users() or [])
+    with user_directories_lock:
+        user_directories[device_id] = directory
+    return directory
+
+
+def load_user_directory(device_id, refresh=False, priority=PRIORITY_ADMIN, timeout=SESSION_LEASE_TIMEOUT):
+    """Serve the device's user directory from memory, leasing the device only to (re)load it"""
+    if not refresh:
+        with user_directories_lock:
+            directory = user_directories.get(device_id)
+        if directory is not None and time.monotonic() - directory["loaded_at"] < USER_CACHE_TTL:
+            return directory
+    with lease_device(device_id, priority=priority, timeout=timeout) as (conn, _):
+        return get_user_directory(device_id, conn, refresh=refresh)
+
+
+def find_directory_user(directory, target):
+    """Look a user up by user_id, then name, then uid"""
+    target = str(target)
+    return (
+        directory["by_user_id"].get(target)
+        or directory["by_name"].get(target)
+        or directory["by_uid"].get(target)
+    )
+
+
+def update_user_directory(device_id, added=(), removed=()):
+    """Apply user writes to the cached directory (copy-on-write, so readers never see it half-done)"""
+    with user_directories_lock:
+        directory = user_directories.get(device_id)
+        if directory is None:
+            return
+        users = {uid: u for uid, u in directory["by_uid"].items()}
+        for u in removed:
+            users.pop(str(u.uid), None)
+        for u in added:
+            users[str(u.uid)] = u
+        updated = index_users(users.values())
+        updated["loaded_at"] = directory["loaded_at"]
+        user_directories[device_id] = updated
+
+
+def invalidate_user_directory(device_id=None):
+    with user_directories_lock:
+        if device_id is None:
+            user_directories.clear()
+        else:
+            user_directories.pop(device_id, None)
+
+
+def remove_user_from_device(device_id, target, timeout=SESSION_LEASE_TIMEOUT):
+    """Delete the user whose user_id, name or uid equals target from one device.
+
+    Returns "deleted" or "not_found"; raises if every delete variant fails.
+    """
+    with lease_device(device_id, priority=PRIORITY_ENROL, timeout=timeout) as (conn, device):
+        dlog = device_log(device)
+        dlog.info("[DELETE] Attempting to delete user %s (%s)", target, device["ip"])
+        
+        # Disable device while performing operations
+        try:
+            conn.disable_device()
+            dlog.debug("[DELETE] Device disabled for deletion")
+        except Exception as disable_error:
+            dlog.warning("[DELETE] Could not disable device: %s", disable_error)
+        
+        try:
+            # Find the correct uid and user_id in the cached directory; a miss
+            # is confirmed against the device in case it was enrolled there
+            directory = get_user_directory(device_id, conn)
+            matched = find_directory_user(directory, target)
+            if matched is None:
+                directory = get_user_directory(device_id, conn, refresh=True)
+                matched = find_directory_user(directory, target)
+            dlog.debug("[DELETE] Searched %d users", len(directory["by_uid"]))
+            
+            if matched is None:
+                dlog.info("[DELETE] User '%s' not found", target)
+                return "not_found"
+            
+            # Try deletion with proper zk library parameters, most specific first
+            uid_to_delete = int(getattr(matched, "uid", 0))
+            user_id_to_delete = str(getattr(matched, "user_id", ""))
+            variants = [
+                ("uid and user_id", lambda: conn.delete_user(uid=uid_to_delete, user_id=user_id_to_delete)),
+                ("uid only", lambda: conn.delete_user(uid=uid_to_delete)),
+                ("user_id only", lambda: conn.delete_user(user_id=user_id_to_delete)),
+                ("legacy string", lambda: conn.delete_user(target)),
+            ]
+            last_error = None
+            for label, delete in variants:
+                try:
+                    dlog.debug("[DELETE] Trying deletion with %s", label)
+                    delete()
+                    dlog.info("[DELETE] Deleted user %s with %s", target, label)
+                    update_user_directory(device_id, removed=[matched])
+                    return "deleted"
+                except Exception as method_error:
+                    dlog.debug("[DELETE] Deletion with %s failed: %s", label, method_error)
+                    last_error = method_error
+            raise Exception(f"All deletion methods failed: {last_error}")
+        finally:
+            # Re-enable device
+            try:
+                conn.enable_device()
+                dlog.debug("[DELETE] Device re-enabled")
+            except Exception as enable_error:
+                dlog.warning("[DELETE] Could not re-enable device: %s", enable_error)
+
+
+def enabled_device_ids():
+    return [device_id for device_id, device in devices.items() if device["enabled"]]
+
+
+def request_deadline(default=None):
+    """Per-request deadline for multi-device operations (?timeout= seconds)"""
+    default = FANOUT_DEADLINE if default is None else default
+    try:
+        return max(0.5, float(request.args.get("timeout", default)))
+    except ValueError:
+        return default
+
+
+def fan_out_to_devices(device_ids, operation, deadline):
+    """Run operation(device_id) on every device in parallel.
+
+    Waits at most deadline seconds and returns a per-device outcome with a
+    status of "ok" (plus "result"), "error" or "timeout" (plus "error"). A
+    timed-out operation keeps running in the background and is not undone.
+    """
+    futures = {device_id: device_fanout_pool.submit(operation, device_id) for device_id in device_ids}
+    wait(futures.values(), timeout=deadline)
+    outcomes = {}
+    for device_id, future in futures.items():
+        device = devices.get(device_id, {})
+        outcome = {"deviceName": device.get("name", device_id), "deviceIp": device.get("ip")}
+        if not future.done():
+            outcome.update(status="timeout", error=f"No answer within {deadline:g}s")
+        elif future.exception() is not None:
+            outcome.update(status="error", error=str(future.exception()))
+        else:
+            outcome.update(status="ok", result=future.result())
+        outcomes[device_id] = outcome
+    return outcomes
+
+
+def format_punch_time(timestamp):
+    return timestamp.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def cursor_key(device):
+    """Cursors follow the terminal's address so they survive device re-numbering"""
+    return f"{device['ip']}:{device['port']}"
+
+
+def load_attendance_cursors():
+    """Load per-device attendance cursors saved by a previous run"""
+    global attendance_cursors
+    try:
+        with open(STATE_FILE, "r", encoding="utf-8") as f:
+            attendance_cursors = json.load(f).get("cursors", {})
+    except FileNotFoundError:
+        attendance_cursors = {}
+    except Exception as error:
+        log.warning("Could not read listener state %s: %s", STATE_FILE, error)
+        attendance_cursors = {}
+
+
+def save_attendance_cursors():
+    """Atomically persist the attendance cursors (caller holds cursor_lock)"""
+    global cursor_dirty, cursor_saved_at
+    tmp_path = f"{STATE_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"cursors": attendance_cursors}, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, STATE_FILE)
+    cursor_dirty = False
+    cursor_saved_at = time.monotonic()
+
+
+def get_attendance_cursor(device):
+    with cursor_lock:
+        return dict(attendance_cursors.get(cursor_key(device), {"index": 0, "timestamp": None}))
+
+
+def update_attendance_cursor(device, debounce=False, **changes):
+    """Move the device's cursor and persist it; with debounce set the write is
+    skipped if the file was saved less than CURSOR_SAVE_INTERVAL ago, and left
+    to the next save or flush_attendance_cursors()"""
+    global cursor_dirty
+    with cursor_lock:
+        cursor = attendance_cursors.setdefault(cursor_key(device), {"index": 0, "timestamp": None})
+        cursor.update(changes)
+        cursor_dirty = True
+        if debounce and time.monotonic() - cursor_saved_at < CURSOR_SAVE_INTERVAL:
+            return
+        try:
+            save_attendance_cursors()
+        except Exception as error:
+            device_log(device).error("Failed to save attendance cursor: %s", error)
+
+
+def flush_attendance_cursors():
+    """Write out cursor moves held back by debounced updates"""
+    with cursor_lock:
+        if not cursor_dirty:
+            return
+        try:
+            save_attendance_cursors()
+        except Exception as error:
+            log.error("Failed to save attendance cursors: %s", error)
+
+
+# pyzk 0.9 has no names for the buffered read commands it uses in read_with_buffer
+ZK_PREPARE_BUFFER = 1503
+# Layout of one attendance record in the device buffer, by record size
+ATTENDANCE_RECORD_FORMATS = {
+    8: struct.Struct("<HB4sB"),
+    16: struct.Struct("<I4sBB2sI"),
+    40: struct.Struct("<H24sB4sB8s"),
+}
+
+
+def read_attendance_chunks(conn, chunk_size=ATTENDANCE_CHUNK_SIZE):
+    """Yield the raw attendance buffer in chunks of at most chunk_size bytes.
+
+    Sends the same commands as pyzk's read_with_buffer, but hands each chunk
+    on as it arrives instead of joining the whole buffer first.
+    """
+    chunk_size = min(chunk_size, 0xFFC0 if conn.tcp else 16 * 1024)
+    command_string = struct.pack("<bhii", 1, const.CMD_ATTLOG_RRQ, 0, 0)
+    response = conn._ZK__send_command(ZK_PREPARE_BUFFER, command_string, 1024)
+    if not response.get("status"):
+        raise ZKErrorResponse("RWB Not supported")
+    if response["code"] == const.CMD_DATA:
+        # A small log comes back inline with the reply
+        data = conn._ZK__data
+        if conn.tcp and len(data) < conn._ZK__tcp_length - 8:
+            data += conn._ZK__recieve_raw_data(conn._ZK__tcp_length - 8 - len(data))
+        yield data
+        return
+    size = struct.unpack("I", conn._ZK__data[1:5])[0]
+    try:
+        start = 0
+        while start < size:
+            length = min(chunk_size, size - start)
+            yield conn._ZK__read_chunk(start, length)
+            start += length
+    finally:
+        # Release the device-side buffer even when the reader stops early
+        conn.free_data()
+
+
+def iter_attendance(conn, device):
+    """Yield the device's attendance records in log order as they are downloaded.
+
+    A drop-in for conn.get_attendance() that keeps memory flat on logs of
+    tens of thousands of records: the buffer is decoded chunk by chunk, and
+    user ids are resolved from the cached user directory rather than a
+    fresh get_users() per read. A uid the directory does not know, e.g. a
+    user just enrolled at the keypad, reloads it once per read; the device
+    holds one buffer at a time, so the read is stopped for that and resumed
+    past the records already yielded. conn.records must be current
+    (read_sizes()). Falls back to get_attendance() on connections without
+    pyzk's buffered read and on record sizes that have no format here.
+    """
+    if not hasattr(conn, "_ZK__read_chunk"):
+        yield from conn.get_attendance() or []
+        return
+    device_id = device["id"]
+    records = conn.records
+    if not records:
+        return
+    directory = get_user_directory(device_id, conn)
+    decode_time = conn._ZK__decode_time
+    reloaded = False
+    yielded = 0
+    while True:
+        reload_needed = False
+        unpacked = iter_attendance_fields(conn, records)
+        try:
+            record_size = next(unpacked, None)
+            if record_size not in ATTENDANCE_RECORD_FORMATS:
+                unpacked.close()
+                if record_size is not None:
+                    device_log(device).warning("Unknown attendance record size %g, reading the log through pyzk", record_size)
+                    yield from itertools.islice(conn.get_attendance() or [], yielded, None)
+                return
+            for position, fields in enumerate(unpacked, 1):
+                if position <= yielded:
+                    continue
+                if record_size == 8:
+                    uid = str(fields[0])
+                    if uid not in directory["by_uid"] and uid not in directory["unknown_uids"]:
+                        if not reloaded:
+                            reload_needed = True
+                            break
+                        directory["unknown_uids"].add(uid)
+                yield decode_attendance_record(record_size, fields, directory, decode_time)
+                yielded += 1
+        finally:
+            unpacked.close()
+        if not reload_needed:
+            return
+        directory = get_user_directory(device_id, conn, refresh=True)
+        # get_users() re-reads the sizes; punches may have landed meanwhile
+        records = conn.records
+        if not records:
+            return
+        reloaded = True
+
+
+def iter_attendance_fields(conn, records):
+    """Yield the record size of the attendance buffer, then each record's unpacked fields.
+
+    The size is total_size / records as pyzk computes it; nothing follows
+    it when it has no format in ATTENDANCE_RECORD_FORMATS.
+    """
+    record = None
+    pending = b""
+    chunks = read_attendance_chunks(conn)
+    try:
+        for chunk in chunks:
+            pending = pending + chunk if pending else chunk
+            if record is None:
+                if len(pending) < 4:
+                    continue
+                record_size = struct.unpack("I", pending[:4])[0] / records
+                yield record_size
+                record = ATTENDANCE_RECORD_FORMATS.get(record_size)
+                if record is None:
+                    return
+                pending = pending[4:]
+            usable = len(pending) - len(pending) % record.size
+            yield from record.iter_unpack(memoryview(pending)[:usable])
+            pending = pending[usable:]
+    finally:
+        chunks.close()
+
+
+def decode_attendance_record(record_size, fields, directory, decode_time):
+    """Build an Attendance from one unpacked record, resolving ids as pyzk does"""
+    if record_size == 8:
+        uid, status, timestamp, punch = fields
+        user = directory["by_uid"].get(str(uid))
+        user_id = user.user_id if user else str(uid)
+    elif record_size == 16:
+        user_id, timestamp, status, punch, _, _ = fields
+        user_id = str(user_id)
+        user = directory["by_user_id"].get(user_id)
+        uid = user.uid if user else user_id
+    else:
+        uid, user_id, status, timestamp, punch, _ = fields
+        user_id = user_id.split(b"\x00")[0].decode(errors="ignore")
+    return Attendance(user_id, decode_time(timestamp), status, punch, uid)
+
+
+def iter_new_records(records, cursor, tail):
+    """Yield the records that lie past the cursor, as they stream in.
+
+    Normally that is every record after cursor["index"]; if the record at the
+    cursor no longer has the cursor's timestamp the log was cleared or
+    rewritten outside the listener, and records are selected by time instead,
+    the cursor's own second included: timestamps have one-second resolution,
+    so other punches may share it, and one already forwarded is dropped by the
+    dedup index. Only records that precede the cursor yet are not older than
+    it are held back until that is known. tail is kept pointing at the last record read, as
+    {"index": position in the log, "timestamp": its time}, so the cursor can
+    be moved there once everything yielded so far has been forwarded.
+    """
+    index = cursor.get("index", 0)
+    last_time = cursor.get("timestamp")
+    held = []
+    anchored = None
+    for position, att in enumerate(records, 1):
+        timestamp = format_punch_time(att.timestamp)
+        tail.update(index=position, timestamp=timestamp)
+        if index == 0 or last_time is None:
+            yield att
+            continue
+        if position < index:
+            if timestamp >= last_time:
+                held.append(att)
+        elif position == index:
+            anchored = timestamp == last_time
+            if not anchored:
+                yield from held
+                if timestamp >= last_time:
+                    yield att
+            held = None
+        elif anchored or timestamp >= last_time:
+            yield att
+    if held:
+        # The log is now shorter than the cursor
+        yield from held
+
+
+def device_identity(device):
+    """Serial number of the device as read on connect, or ip:port until then"""
+    entry = listen_status["devices"].get(device["id"]) or {}
+    return entry.get("serial") or f"{device['ip']}:{device['port']}"
+
+
+def read_device_serial(conn):
+    try:
+        return conn.get_serialnumber()
+    except Exception:
+        return None
+
+
+def check_duplicate_punch(device, user_id, punch_time, undo):
+    """Remember a punch about to be forwarded; returns why it should be
+    dropped instead ("duplicate" or "double_tap"), or None to forward it.
+
+    What was remembered is appended to undo, for forget_punches() if the
+    punch then never makes it into the outbox.
+    """
+    key = (device_identity(device), str(user_id), punch_time)
+    with dedup_lock:
+        if key in forwarded_punches:
+            return "duplicate"
+        forwarded_punches[key] = None
+        undo.append((key, None))
+        if len(forwarded_punches) > DEDUP_CAPACITY:
+            forwarded_punches.popitem(last=False)
+        if DEDUP_WINDOW <= 0:
+            return None
+        previous = last_user_punch.get(key[1])
+        if previous is not None and 0 <= (punch_time - previous).total_seconds() < DEDUP_WINDOW:
+            return "double_tap"
+        # Punches from a backlog can arrive out of order; never move backwards
+        if previous is None or punch_time > previous:
+            undo.append((None, (key[1], previous)))
+            last_user_punch[key[1]] = punch_time
+            last_user_punch.move_to_end(key[1])
+            if len(last_user_punch) > DEDUP_CAPACITY:
+                last_user_punch.popitem(last=False)
+        return None
+
+
+def forget_punches(undo):
+    """Roll back check_duplicate_punch() for punches that were not queued,
+    so the re-read after a failed enqueue forwards them instead of dropping them"""
+    with dedup_lock:
+        for key, user_punch in reversed(undo):
+            if key is not None:
+                forwarded_punches.pop(key, None)
+                continue
+            user_id, previous = user_punch
+            if previous is None:
+                last_user_punch.pop(user_id, None)
+            else:
+                last_user_punch[user_id] = previous
+
+
+def forward_punches(device, records, source, backlog=False):
+    """Store punches in the history and queue the ones not already forwarded for Node.
+
+    With backlog set they are queued as catch-up punches (see BACKFILL_RATE)
+    instead of one live delivery each.
+    """
+    if not records:
+        return
+    inc_counter("zk_punches_total", len(records), device=device["id"], source=source)
+    record_attendance(device, records)
+    dlog = device_log(device)
+    payloads = []
+    # Dedup entries for punches not yet committed to the outbox
+    undo = []
+    try:
+        for att in records:
+            user_id = att.user_id
+            timestamp = format_punch_time(att.timestamp)
+            reason = check_duplicate_punch(device, user_id, att.timestamp, undo)
+            if reason:
+                dlog.debug("Skipping %s punch: %s at %s", reason, user_id, timestamp)
+                inc_counter("zk_suppressed_punches_total", device=device["id"], reason=reason)
+                continue
+            if backlog:
+                payloads.append({"userId": str(user_id), "time": timestamp, "deviceIp": device["ip"]})
+                continue
+            dlog.info("Attendance (%s): %s at %s", source, user_id, timestamp)
+            send_to_node(user_id, timestamp, device["ip"])
+            undo.clear()
+        if payloads:
+            dlog.info("Queued %d backlog punches for catch-up", len(payloads))
+            enqueue_backlog(device["id"], payloads)
+    except Exception:
+        forget_punches(undo)
+        raise
+
+
+def poll_attendance_once(conn, device):
+    """Forward the attendance records newer than the device's cursor; returns how many.
+
+    Records are forwarded in batches of ATTENDANCE_FORWARD_BATCH while the
+    log is still downloading, and the cursor follows each batch.
+    """
+    cursor = get_attendance_cursor(device)
+    # Cheap size query first so an idle device never sends its whole log
+    conn.read_sizes()
+    if conn.records == cursor["index"]:
+        return 0
+    # Decided up front from the sizes so every batch of one read goes the same way
+    expected = conn.records - cursor["index"] if conn.records > cursor["index"] else conn.records
+    backlog = expected >= BACKFILL_THRESHOLD
+    tail = {"index": 0}
+    forwarded = 0
+    batch = []
+    for att in iter_new_records(iter_attendance(conn, device), cursor, tail):
+        batch.append(att)
+        if len(batch) >= ATTENDANCE_FORWARD_BATCH:
+            forward_punches(device, batch, "poll", backlog=backlog)
+            forwarded += len(batch)
+            batch = []
+            update_attendance_cursor(device, **tail)
+    forward_punches(device, batch, "poll", backlog=backlog)
+    forwarded += len(batch)
+    update_attendance_cursor(device, **tail)
+    return forwarded
+
+
+def attendance_compaction_due(device):
+    """Whether the scheduled clear of the device log should run now"""
+    if COMPACT_AT_HOUR is None:
+        return False
+    now = datetime.now()
+    if now.hour < COMPACT_AT_HOUR:
+        return False
+    return get_attendance_cursor(device).get("compacted_on") != now.date().isoformat()
+
+
+def compact_attendance_log(conn, device):
+    """Clear the device log once everything on it has been forwarded"""
+    device_log(device).info("Compacting attendance log...")
+    # Lock the terminal so no punch can land between the final read and the clear
+    try:
+        conn.disable_device()
+    except Exception as disable_error:
+        device_log(device).warning("Could not disable device for compaction: %s", disable_error)
+        return
+    try:
+        poll_attendance_once(conn, device)
+        conn.clear_attendance()
+        update_attendance_cursor(device, index=0, compacted_on=datetime.now().date().isoformat())
+        device_log(device).info("Attendance log compacted")
+    except Exception as clear_error:
+        device_log(device).error("Failed to compact attendance log: %s", clear_error)
+    finally:
+        try:
+            conn.enable_device()
+        except Exception:
+            pass
+
+
+@contextmanager
+def cached_user_list(conn, device_id):
+    """Serve conn.get_users() from the cached user directory for the duration.
+
+    pyzk's live_capture() downloads the whole user table every time it
+    starts, and capture restarts after each API call that borrows the session.
+    """
+    users = list(get_user_directory(device_id, conn)["by_uid"].values())
+    conn.get_users = lambda: users
+    try:
+        yield
+    finally:
+        del conn.get_users
+
+
+def capture_live_attendance(conn, device, stop_event):
+    """Forward punches from the device's real-time event stream until stop_event
+    is set, the scheduled compaction is due or another caller wants the session"""
+    try:
+        with cached_user_list(conn, device["id"]):
+            capture_live_events(conn, device, stop_event)
+    finally:
+        flush_attendance_cursors()
+
+
+def capture_live_events(conn, device, stop_event):
+    for att in conn.live_capture(new_timeout=LIVE_CAPTURE_TIMEOUT):
+        if stop_event.is_set():
+            # live_capture checks this flag before its next read and then
+            # unregisters the event stream on the device
+            conn.end_live_capture = True
+            continue
+        if att is None:
+            # Read timed out with no punch, nothing went over the wire
+            flush_attendance_cursors()
+            if attendance_compaction_due(device) or device_lease_contended(device["id"]):
+                conn.end_live_capture = True
+            continue
+        forward_punches(device, [att], "live")
+        # The punch is also appended to the device log; keep the cursor in step
+        cursor = get_attendance_cursor(device)
+        update_attendance_cursor(
+            device, debounce=True, index=cursor["index"] + 1, timestamp=format_punch_time(att.timestamp)
+        )
+        if device_lease_contended(device["id"]):
+            conn.end_live_capture = True
+
+
+def in_working_hours(now=None):
+    start, end = WORKING_HOURS
+    hour = (now or datetime.now()).hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+def next_poll_interval(previous, new_records):
+    """Adapt a device's poll interval to its recent activity and the time of day"""
+    if new_records:
+        return POLL_INTERVAL
+    ceiling = POLL_MAX_INTERVAL if in_working_hours() else POLL_OFF_HOURS_INTERVAL
+    return min(max(previous, POLL_INTERVAL) * POLL_BACKOFF_FACTOR, ceiling)
+
+
+def jittered(seconds):
+    return seconds * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+
+def wait_for_poll_slot(stop_event):
+    """Wait until one of the POLL_CONCURRENCY poll slots is free, without taking it; False if the listener was stopped meanwhile"""
+    while not poll_slots.acquire(timeout=0.5):
+        if stop_event.is_set():
+            return False
+    poll_slots.release()
+    return True
+
+
+def classify_failure(error):
+    """Sort a listener failure into network, auth, refused or other"""
+    if isinstance(error, (ZKNetworkError, ZKErrorConnection, OSError)):
+        return "network"
+    if isinstance(error, ZKErrorResponse):
+        return "auth" if "unauth" in str(error).lower() else "refused"
+    return "other"
+
+
+def failure_backoff(failure, consecutive_failures):
+    """Exponential backoff with full jitter, capped at BREAKER_MAX_DELAY"""
+    ceiling = min(FAILURE_BASE_DELAY[failure] * 2 ** (consecutive_failures - 1), BREAKER_MAX_DELAY)
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def breaker_open(device_id):
+    return listen_status["devices"].get(device_id, {}).get("breaker") == "open"
+
+
+def wait_until_reachable(device_id, stop_event):
+    """TCP-probe a device with an open breaker until it accepts a connection.
+
+    Returns False if the listener is stopped or the device deleted or
+    disabled meanwhile.
+    """
+    while not stop_event.wait(jittered(BREAKER_PROBE_INTERVAL)):
+        device = devices.get(device_id)
+        if device is None or not device["enabled"]:
+            return False
+        if validate_device_connectivity(device["ip"], device["port"], timeout=BREAKER_PROBE_TIMEOUT):
+            return True
+    return False
+
+
+def listen_loop_for_device(device_id, stop_event):
     """Listen loop for a specific device with enhanced reconnection"""
-    global listen_status
-    conn = None
     device = devices.get(device_id)
     
     if not device:
-        print(f"Device {device_id} not found")
+        log.warning("Device %s not found", device_id)
         return
     
     # Initialize device entry in listen_status if it doesn't exist
     if device_id not in listen_status["devices"]:
-        listen_status["devices"][device_id] = {
-            "running": False,
-            "last_error": None,
-            "name": device["name"],
-            "ip": device["ip"],
-            "connection_attempts": 0,
-            "last_connection_time": None,
-            "reconnection_count": 0
-        }
+        update_listen_entry(
+            device_id,
+            create=True,
+            running=False,
+            last_error=None,
+            name=device["name"],
+            ip=device["ip"],
+            connection_attempts=0,
+            last_connection_time=None,
+            reconnection_count=0
+        )
     
-    # Enhanced reconnection parameters
-    max_reconnection_attempts = 10
-    base_reconnect_delay = 5  # seconds
-    max_reconnect_delay = 60  # seconds
+    use_live_capture = LISTEN_MODE == "live"
+    update_listen_entry(device_id, mode="live" if use_live_capture else "poll")
+    
+    poll_interval = POLL_INTERVAL
     connection_attempts = 0
+    # Failures in a row of the same class; the breaker only counts network ones
+    consecutive_failures = 0
+    last_failure = None
+    # Set when every poll slot was busy; the next pass waits for one before leasing
+    slot_wait = False
     
     try:
-        safe_print(f"Starting attendance listener for {device['name']} ({device['ip']})...")
+        device_log(device).info("Starting attendance listener (%s)...", device["ip"])
         
-        while not listen_stop_events.get(device_id, threading.Event()).is_set():
+        while not stop_event.is_set():
+            # Records are replaced rather than edited, so pick up the latest one
+            device = devices.get(device_id)
+            if device is None or not device["enabled"]:
+                # Deleted or disabled (possibly while the breaker was probing)
+                break
+            if slot_wait:
+                if not wait_for_poll_slot(stop_event):
+                    break
+                slot_wait = False
             try:
-                # Attempt connection with progressive backoff
-                if conn is None or not device.get("connected", False):
+                if not device.get("connected", False):
                     connection_attempts += 1
-                    listen_status["devices"][device_id]["connection_attempts"] = connection_attempts
-                    
-                    safe_print(f"[{device['name']}] Connection attempt {connection_attempts}...")
-                    conn = connect_with_retry(device["ip"], device["port"], max_retries=3, retry_delay=3)
-                    
-                    if conn:
-                        device["status"] = "listening"
-                        device["connected"] = True
-                        listen_status["devices"][device_id].update({
-                            "running": True,
-                            "last_error": None,
-                            "last_connection_time": datetime.now().isoformat(),
-                            "reconnection_count": listen_status["devices"][device_id].get("reconnection_count", 0) + 1
-                        })
-                        connection_attempts = 0  # Reset on successful connection
-                        safe_print(f"Connected to {device['name']} for listening")
+                    update_listen_entry(device_id, connection_attempts=connection_attempts)
+                    device_log(device).info("Connection attempt %d...", connection_attempts)
                 
-                # Main listening loop
-                attendances = conn.get_attendance()
-                if attendances:
-                    for att in attendances:
-                        user_id = att.user_id
-                        timestamp = att.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-                        safe_print(f"[{device['name']}] Attendance: {user_id} at {timestamp}")
-                        send_to_node(user_id, timestamp, device["ip"])
-                    # Clear attendance logs to prevent duplicates
-                    try:
-                        conn.clear_attendance()
-                    except Exception as clear_error:
-                        safe_print(f"[{device['name']}] Failed to clear attendance: {clear_error}")
+                slot_held = False
+                try:
+                    # The listener shares the device's ZK session with the API
+                    with lease_device(device_id, priority=PRIORITY_POLL, timeout=None) as (conn, _):
+                        # Polls (and reconnect catch-ups) share a capped number of slots,
+                        # taken only once the session is ours so a listener queued behind
+                        # a long API call (a bulk enrolment) does not hold one meanwhile.
+                        # With none free, wait outside the lease so commands queued for
+                        # this device are not held up by an idle listener
+                        slot_held = poll_slots.acquire(blocking=False)
+                        if not slot_held:
+                            slot_wait = True
+                            continue
+                        if not device.get("connected", False):
+                            device = update_device(device_id, status="listening", connected=True) or device
+                            update_listen_entry(
+                                device_id,
+                                running=True,
+                                state="running",
+                                breaker="closed",
+                                failure=None,
+                                last_error=None,
+                                last_connection_time=datetime.now().isoformat(),
+                                serial=read_device_serial(conn),
+                                reconnection_count=listen_status["devices"].get(device_id, {}).get("reconnection_count", 0) + 1
+                            )
+                            connection_attempts = 0  # Reset on successful connection
+                            consecutive_failures = 0
+                            last_failure = None
+                            inc_counter("zk_reconnects_total", device=device_id)
+                            device_log(device).info("Connected for listening")
+                            publish_device_state(device_id)
+                        
+                        # Forward anything newer than the cursor (including punches made
+                        # while we were disconnected)
+                        poll_started = time.perf_counter()
+                        new_records = poll_attendance_once(conn, device)
+                        observe("zk_poll_duration_seconds", time.perf_counter() - poll_started, device=device_id)
+                        observe("zk_poll_records", new_records, device=device_id)
+                        if attendance_compaction_due(device):
+                            compact_attendance_log(conn, device)
+                        poll_slots.release()
+                        slot_held = False
+                        
+                        if use_live_capture:
+                            # Block on the event stream until a stop, a compaction or
+                            # another caller needs the session
+                            try:
+                                capture_live_attendance(conn, device, stop_event)
+                            except ZKErrorResponse as live_error:
+                                device_log(device).warning("Live capture not supported (%s), falling back to polling", live_error)
+                                use_live_capture = False
+                                update_listen_entry(device_id, mode="poll")
+                                publish_device_state(device_id)
+                finally:
+                    if slot_held:
+                        poll_slots.release()
                 
-                # Short sleep between attendance checks
-                time.sleep(1)
+                if use_live_capture:
+                    # Commands queued meanwhile outrank the next capture
+                    continue
                 
-            except Exception as inner_error:
-                device["connected"] = False
-                device["status"] = "error"
+                # Quiet devices are polled less often, busy ones every POLL_INTERVAL
+                next_interval = next_poll_interval(poll_interval, new_records)
+                if next_interval != poll_interval:
+                    update_listen_entry(device_id, poll_interval=round(next_interval, 2))
+                poll_interval = next_interval
+                stop_event.wait(jittered(poll_interval))
                 
-                if device_id in listen_status["devices"]:
-                    listen_status["devices"][device_id]["last_error"] = str(inner_error)
+            except Exception as inner_error:
+                failure = classify_failure(inner_error)
+                if failure != last_failure:
+                    consecutive_failures = 0
+                last_failure = failure
+                consecutive_failures += 1
+                inc_counter("zk_listener_failures_total", device=device_id, failure=failure)
+                poll_interval = POLL_INTERVAL
+                update_device(device_id, connected=False, status="offline" if failure == "network" else "error")
                 
-                safe_print(f"[{device['name']}] Connection error:", inner_error)
+                if failure == "network" and consecutive_failures >= BREAKER_THRESHOLD:
+                    # Stop reconnecting; a TCP probe tells us when it is worth trying again
+                    update_listen_entry(
+                        device_id,
+                        state="offline",
+                        breaker="open",
+                        failure=failure,
+                        last_error=str(inner_error)
+                    )
+                    publish_device_state(device_id)
+                    device_log(device).warning("Unreachable after %d attempts, probing every ~%gs", consecutive_failures, BREAKER_PROBE_INTERVAL)
+                    if not wait_until_reachable(device_id, stop_event):
+                        continue
+                    # Half-open: the next pass makes one real connection attempt
+                    update_listen_entry(device_id, state="reconnecting", breaker="half_open")
+                    publish_device_state(device_id)
+                    device_log(device).info("Answering again, reconnecting")
+                    continue
                 
-                # Determine if we should attempt reconnection
-                should_reconnect = (
-                    "can't reach device" in str(inner_error).lower() or
-                    "network" in str(inner_error).lower() or
-                    "connection" in str(inner_error).lower() or
-                    "timeout" in str(inner_error).lower()
+                update_listen_entry(
+                    device_id,
+                    state="reconnecting",
+                    failure=failure,
+                    last_error=str(inner_error)
                 )
+                publish_device_state(device_id)
                 
-                if should_reconnect and connection_attempts < max_reconnection_attempts:
-                    # Progressive backoff for reconnection
-                    reconnect_delay = min(base_reconnect_delay * (2 ** min(connection_attempts, 4)), max_reconnect_delay)
-                    
-                    safe_print(f"[{device['name']}] Attempting reconnection in {reconnect_delay}s... (attempt {connection_attempts + 1}/{max_reconnection_attempts})")
-                    
-                    try:
-                        if conn:
-                            conn.disconnect()
-                    except Exception:
-                        pass
-                    
-                    # Wait before reconnection attempt
-                    time.sleep(reconnect_delay)
-                    continue
-                elif connection_attempts >= max_reconnection_attempts:
-                    safe_print(f"[{device['name']}] Max reconnection attempts reached. Stopping listener.")
-                    break
-                else:
-                    # For non-network errors, wait and retry
-                    safe_print(f"[{device['name']}] Waiting 10s before retry...")
-                    time.sleep(10)
+                delay = failure_backoff(failure, consecutive_failures)
+                device_log(device).warning("%s error: %s; retrying in %.1fs", failure, inner_error, delay)
+                stop_event.wait(delay)
                     
     except Exception as error:
-        device["status"] = "error"
-        device["connected"] = False
-        if device_id in listen_status["devices"]:
-            listen_status["devices"][device_id]["last_error"] = str(error)
-        safe_print(f"[{device['name']}] Critical listener error:", error)
+        update_device(device_id, status="error", connected=False)
+        update_listen_entry(device_id, last_error=str(error))
+        device_log(device).exception("Critical listener error: %s", error)
     finally:
-        device["status"] = "offline"
-        device["connected"] = False
-        if device_id in listen_status["devices"]:
-            listen_status["devices"][device_id]["running"] = False
-        
-        try:
-            if conn:
-                conn.disconnect()
-                safe_print(f"Disconnected {device['name']} listener connection")
-        except Exception:
-            pass
+        # After a restart the replacement thread owns the device's state
+        if listen_threads.get(device_id) in (None, threading.current_thread()):
+            update_device(device_id, status="offline", connected=False)
+            # Nobody probes a stopped device, so let API calls try it again
+            update_listen_entry(device_id, running=False, state="stopped", breaker="closed")
+            publish_device_state(device_id)
+        device_log(device).info("Listener stopped")
+
+
+def listener_alive(device_id):
+    thread = listen_threads.get(device_id)
+    return thread is not None and thread.is_alive()
+
+
+def start_device_listener(device_id):
+    """Start, or restart, one device's listener without touching the others"""
+    global listen_threads, listen_stop_events
+    with registry_lock:
+        device = devices.get(device_id)
+        if device is None or not device["enabled"]:
+            return False
+        # A restart gets a fresh stop event; the old thread keeps its own,
+        # already set, and exits after its current read
+        previous = listen_stop_events.get(device_id)
+        if previous is not None:
+            previous.set()
+        stop_event = threading.Event()
+        # The new thread connects and reports in as if the device were fresh
+        update_device(device_id, connected=False)
+        update_listen_entry(
+            device_id,
+            create=True,
+            running=False,
+            state="starting",
+            breaker="closed",
+            last_error=None,
+            name=device["name"],
+            ip=device["ip"]
+        )
+        thread = threading.Thread(
+            target=listen_loop_for_device, 
+            args=(device_id, stop_event), 
+            daemon=True
+        )
+        listen_stop_events = {**listen_stop_events, device_id: stop_event}
+        listen_threads = {**listen_threads, device_id: thread}
+        thread.start()
+    device_log(device).info("Started listener thread")
+    return True
+
+
+def stop_device_listener(device_id):
+    """Ask one device's listener to stop without waiting for it.
+
+    Returns its thread (or None) for callers that want to join it; the
+    listen entry's state goes "stopping" and then "stopped" once the
+    thread has let go of the device.
+    """
+    stop_event = listen_stop_events.get(device_id)
+    if stop_event is not None:
+        stop_event.set()
+    thread = listen_threads.get(device_id)
+    if thread is not None and thread.is_alive():
+        update_listen_entry(device_id, state="stopping")
+        publish_device_state(device_id)
+    return thread
+
+
+def listener_state(device_id):
+    """Listen entry for one device plus whether its thread is still alive"""
+    entry = dict(listen_status["devices"].get(device_id) or {"running": False, "state": "stopped"})
+    entry["alive"] = listener_alive(device_id)
+    if not entry["alive"] and entry.get("state") == "stopping":
+        # The thread finished between the stop request and its state update
+        entry["state"] = "stopped"
+    return entry
 
 
 def start_all_listeners():
     """Start listening on all enabled devices"""
-    global listen_status
-    listen_status["running"] = True
-    listen_status["last_error"] = None
+    update_listen_status(running=True, last_error=None)
     
     for device_id, device in devices.items():
         if device["enabled"]:
-            # Initialize device entry in listen_status
-            if device_id not in listen_status["devices"]:
-                listen_status["devices"][device_id] = {
-                    "running": False,
-                    "last_error": None,
-                    "name": device["name"],
-                    "ip": device["ip"]
-                }
-            
-            if device_id not in listen_stop_events:
-                listen_stop_events[device_id] = threading.Event()
-            listen_stop_events[device_id].clear()
-            
-            thread = threading.Thread(
-                target=listen_loop_for_device, 
-                args=(device_id,), 
-                daemon=True
-            )
-            thread.start()
-            listen_threads[device_id] = thread
-            safe_print(f"Started listener thread for {device['name']}")
+            start_device_listener(device_id)
+    
+    publish_listen_status()
 
 
-def stop_all_listeners():
-    """Stop all listening threads"""
-    global listen_status
+def stop_all_listeners(wait=0):
+    """Stop all listening threads, waiting up to wait seconds in total for them to finish"""
+    threads = [stop_device_listener(device_id) for device_id in list(listen_stop_events)]
     
-    for device_id, stop_event in listen_stop_events.items():
-        stop_event.set()
-    
-    # Wait for threads to finish
-    for device_id, thread in listen_threads.items():
-        if thread.is_alive():
-            thread.join(timeout=5)
+    deadline = time.monotonic() + wait
+    for thread in threads:
+        remaining = deadline - time.monotonic()
+        if thread is None or remaining <= 0:
+            continue
+        thread.join(timeout=remaining)
     
-    listen_status["running"] = False
-    listen_status["devices"] = {}
-    listen_threads.clear()
-    safe_print("Stopped all listeners")
+    update_listen_status(running=False)
+    publish_listen_status()
+    safe_print("Stopping all listeners")
 
 
 # ============= Flask Control API =============
@@ -526,8 +2785,10 @@ def web_interface():
                 <h3> Device Discovery</h3>
                 <div class="controls">
                     <input type="text" id="networkRange" placeholder="Network range (e.g., 192.168.1)" value="192.168.1">
-                    <button class="btn-info" onclick="scanDevices()"> Scan Network</button>
+                    <button class="btn-info" id="scanButton" onclick="scanDevices()"> Scan Network</button>
+                    <button class="btn-danger" id="cancelScanButton" onclick="cancelScan()" style="display: none;"> Stop Scan</button>
                 </div>
+                <div id="scanProgress" style="display: none;"></div>
                 <div id="scanResults" class="scan-results" style="display: none;">
                     <div class="loading">Scanning network...</div>
                 </div>
@@ -546,46 +2807,100 @@ def web_interface():
             </div>
 
             <div class="section">
-                <h3> System Status</h3>
-                <div id="systemStatus">
-                    <div class="loading">Loading status...</div>
+                <h3> System Status</h3>
+                <div id="systemStatus">
+                    <div class="loading">Loading status...</div>
+                </div>
+            </div>
+
+            <div class="section">
+                <h3> Recent Punches</h3>
+                <div id="recentPunches">
+                    <p>No punches yet.</p>
                 </div>
             </div>
         </div>
 
         <script>
             let devices = {};
+            let listenStatus = {devices: {}};
+            let recentPunches = [];
+
+            let scanSource = null;
+            let scanId = null;
+
+            function renderScannedDevice(device) {
+                return `
+                    <div class="device-card online">
+                        <h4>${device.ip}:${device.port}</h4>
+                        <p><strong>Platform:</strong> ${device.platform || 'Unknown'}</p>
+                        <p><strong>Firmware:</strong> ${device.firmwareVersion || 'Unknown'}</p>
+                        <p><strong>Serial:</strong> ${device.serialNumber || 'Unknown'}</p>
+                        <button class="btn-success" onclick="addDevice('${device.ip}', ${device.port})">Add Device</button>
+                    </div>
+                `;
+            }
+
+            function finishScan(message) {
+                if (scanSource) {
+                    scanSource.close();
+                    scanSource = null;
+                }
+                scanId = null;
+                document.getElementById('scanButton').disabled = false;
+                document.getElementById('cancelScanButton').style.display = 'none';
+                const resultsDiv = document.getElementById('scanResults');
+                if (!resultsDiv.querySelector('.device-card')) {
+                    resultsDiv.innerHTML = `<p>${message}</p>`;
+                }
+            }
 
-            async function scanDevices() {
+            function scanDevices() {
                 const networkRange = document.getElementById('networkRange').value;
                 const resultsDiv = document.getElementById('scanResults');
+                const progressDiv = document.getElementById('scanProgress');
                 resultsDiv.style.display = 'block';
                 resultsDiv.innerHTML = '<div class="loading">Scanning network...</div>';
+                progressDiv.style.display = 'block';
+                progressDiv.textContent = '';
+                document.getElementById('scanButton').disabled = true;
+                document.getElementById('cancelScanButton').style.display = 'inline-block';
+
+                scanSource = new EventSource(`/api/scan/stream?range=${encodeURIComponent(networkRange)}`);
+                scanSource.addEventListener('start', (e) => {
+                    scanId = JSON.parse(e.data).scanId;
+                });
+                scanSource.addEventListener('device', (e) => {
+                    const loading = resultsDiv.querySelector('.loading');
+                    if (loading) loading.remove();
+                    resultsDiv.insertAdjacentHTML('beforeend', renderScannedDevice(JSON.parse(e.data)));
+                });
+                scanSource.addEventListener('progress', (e) => {
+                    const p = JSON.parse(e.data);
+                    progressDiv.textContent = `Probed ${p.probed}/${p.total} hosts, ${p.responding} responding, ${p.found} devices`;
+                });
+                scanSource.addEventListener('done', (e) => {
+                    const p = JSON.parse(e.data);
+                    progressDiv.textContent = `${p.cancelled ? 'Stopped' : 'Finished'}: probed ${p.probed}/${p.total} hosts, found ${p.found} devices`;
+                    finishScan('No devices found on the network.');
+                });
+                scanSource.addEventListener('error', (e) => {
+                    // Server-sent "error" events carry data; connection errors do not
+                    const message = e.data ? JSON.parse(e.data).error : 'Scan connection lost';
+                    finishScan(`<span style="color: red;">Error: ${message}</span>`);
+                });
+            }
 
-                try {
-                    const response = await fetch(`/api/scan?range=${encodeURIComponent(networkRange)}`);
-                    const data = await response.json();
-                    
-                    if (data.ok) {
-                        if (data.data.length > 0) {
-                            resultsDiv.innerHTML = data.data.map(device => `
-                                <div class="device-card online">
-                                    <h4>${device.ip}:${device.port}</h4>
-                                    <p><strong>Platform:</strong> ${device.platform || 'Unknown'}</p>
-                                    <p><strong>Firmware:</strong> ${device.firmwareVersion || 'Unknown'}</p>
-                                    <p><strong>Serial:</strong> ${device.serialNumber || 'Unknown'}</p>
-                                    <button class="btn-success" onclick="addDevice('${device.ip}', ${device.port})">Add Device</button>
-                                </div>
-                            `).join('');
-                        } else {
-                            resultsDiv.innerHTML = '<p>No devices found on the network.</p>';
-                        }
-                    } else {
-                        resultsDiv.innerHTML = `<p style="color: red;">Error: ${data.error}</p>`;
+            async function cancelScan() {
+                if (scanId) {
+                    try {
+                        await fetch(`/api/scan/${scanId}/cancel`, {method: 'POST'});
+                        return;
+                    } catch (error) {
+                        // Fall through and drop the stream, which also stops the sweep
                     }
-                } catch (error) {
-                    resultsDiv.innerHTML = `<p style="color: red;">Error: ${error.message}</p>`;
                 }
+                finishScan('Scan stopped.');
             }
 
             async function addDevice(ip, port) {
@@ -628,7 +2943,8 @@ def web_interface():
                     const response = await fetch('/api/listen/status');
                     const data = await response.json();
                     if (data.ok) {
-                        renderSystemStatus(data.data);
+                        listenStatus = data.data;
+                        renderSystemStatus(listenStatus);
                     }
                 } catch (error) {
                     console.error('Error refreshing status:', error);
@@ -660,7 +2976,8 @@ def web_interface():
 
             function renderSystemStatus(status) {
                 const container = document.getElementById('systemStatus');
-                const deviceStatuses = Object.values(status.devices || {});
+                const deviceEntries = Object.entries(status.devices || {});
+                const deviceStatuses = deviceEntries.map(([, device]) => device);
                 const runningCount = deviceStatuses.filter(d => d.running).length;
                 
                 container.innerHTML = `
@@ -668,10 +2985,14 @@ def web_interface():
                     <p><strong>Active Listeners:</strong> ${runningCount}/${deviceStatuses.length}</p>
                     ${status.last_error ? `<p style="color: red;"><strong>Last Error:</strong> ${status.last_error}</p>` : ''}
                     <div style="margin-top: 15px;">
-                        ${deviceStatuses.map(device => `
+                        ${deviceEntries.map(([deviceId, device]) => `
                             <div style="padding: 5px; border-left: 3px solid ${device.running ? '#4CAF50' : '#f44336'}; margin: 5px 0; padding-left: 10px;">
-                                <strong>${device.name}</strong> (${device.ip}) - ${device.running ? 'Running' : 'Stopped'}
+                                <strong>${device.name}</strong> (${device.ip}) - ${device.state || (device.running ? 'running' : 'stopped')}
+                                <button class="btn-success" onclick="controlListener('${deviceId}', 'start')">Start</button>
+                                <button class="btn-warning" onclick="controlListener('${deviceId}', 'restart')">Restart</button>
+                                <button class="btn-danger" onclick="controlListener('${deviceId}', 'stop')">Stop</button>
                                 ${device.last_error ? `<br><small style="color: red;">${device.last_error}</small>` : ''}
+                                ${device.backfill && device.backfill.state === 'draining' ? `<br><small>Catching up: ${device.backfill.delivered}/${device.backfill.queued} sent, ~${device.backfill.eta_seconds}s left</small>` : ''}
                             </div>
                         `).join('')}
                     </div>
@@ -708,6 +3029,18 @@ def web_interface():
                 }
             }
 
+            async function controlListener(deviceId, action) {
+                try {
+                    const response = await fetch(`/api/devices/${deviceId}/listen/${action}`, {method: 'POST'});
+                    const data = await response.json();
+                    if (!data.ok) {
+                        alert(`Error: ${data.error}`);
+                    }
+                } catch (error) {
+                    alert(`Error: ${error.message}`);
+                }
+            }
+
             async function toggleDevice(deviceId) {
                 try {
                     const device = devices[deviceId];
@@ -776,13 +3109,63 @@ def web_interface():
                 }
             }
 
+            function renderRecentPunches() {
+                const container = document.getElementById('recentPunches');
+                if (recentPunches.length === 0) {
+                    container.innerHTML = '<p>No punches yet.</p>';
+                    return;
+                }
+                const namesByIp = Object.fromEntries(Object.values(devices).map(d => [d.ip, d.name]));
+                container.innerHTML = recentPunches.map(punch => `
+                    <div style="padding: 3px 0;">
+                        <strong>${punch.userId}</strong> at ${punch.time} on ${namesByIp[punch.deviceIp] || punch.deviceIp}
+                    </div>
+                `).join('');
+            }
+
+            function connectEvents() {
+                // The server pushes a snapshot on connect and on every reconnect,
+                // then individual changes as the listeners make them
+                const source = new EventSource('/api/events');
+                source.addEventListener('snapshot', (e) => {
+                    const data = JSON.parse(e.data);
+                    devices = data.devices;
+                    listenStatus = data.status;
+                    renderDevices();
+                    renderSystemStatus(listenStatus);
+                });
+                source.addEventListener('device', (e) => {
+                    const data = JSON.parse(e.data);
+                    if (data.device) {
+                        devices[data.id] = data.device;
+                    }
+                    listenStatus.devices = listenStatus.devices || {};
+                    if (data.listen) {
+                        listenStatus.devices[data.id] = data.listen;
+                    }
+                    renderDevices();
+                    renderSystemStatus(listenStatus);
+                });
+                source.addEventListener('device_removed', (e) => {
+                    const id = JSON.parse(e.data).id;
+                    delete devices[id];
+                    if (listenStatus.devices) delete listenStatus.devices[id];
+                    renderDevices();
+                    renderSystemStatus(listenStatus);
+                });
+                source.addEventListener('status', (e) => {
+                    listenStatus = JSON.parse(e.data);
+                    renderSystemStatus(listenStatus);
+                });
+                source.addEventListener('punch', (e) => {
+                    recentPunches.unshift(JSON.parse(e.data));
+                    recentPunches = recentPunches.slice(0, 20);
+                    renderRecentPunches();
+                });
+            }
+
             // Initialize
-            refreshDevices();
-            refreshStatus();
-            setInterval(() => {
-                refreshDevices();
-                refreshStatus();
-            }, 5000);
+            connectEvents();
         </script>
     </body>
     </html>
@@ -801,16 +3184,18 @@ def api_add_device():
     """Add a new device"""
     body = request.get_json(force=True) or {}
     try:
-        device_id = f"device_{len(devices) + 1}"
-        devices[device_id] = {
-            "id": device_id,
-            "ip": body.get("ip"),
-            "port": body.get("port", 4370),
-            "name": body.get("name", f"Device {len(devices) + 1}"),
-            "enabled": body.get("enabled", True),
-            "status": "unknown",
-            "info": {}
-        }
+        if not body.get("ip"):
+            return jsonify({"ok": False, "error": "ip is required"}), 400
+        with registry_lock:
+            device_id = allocate_device_id()
+            apply_device_config(device_id, {
+                "id": device_id,
+                "name": body.get("name") or f"Device {device_id[7:]}",
+                "ip": body["ip"],
+                "port": int(body.get("port", 4370)),
+                "enabled": bool(body.get("enabled", True)),
+            })
+            save_device_store()
         return jsonify({"ok": True, "data": devices[device_id]})
     except Exception as error:
         return jsonify({"ok": False, "error": str(error)}), 500
@@ -819,44 +3204,48 @@ def api_add_device():
 @app.get("/api/devices/<device_id>")
 def api_get_device(device_id):
     """Get specific device info"""
-    if device_id not in devices:
+    device = devices.get(device_id)
+    if device is None:
         return jsonify({"ok": False, "error": "Device not found"}), 404
-    return jsonify({"ok": True, "data": devices[device_id]})
+    return jsonify({"ok": True, "data": device})
 
 
 @app.put("/api/devices/<device_id>")
 def api_update_device(device_id):
     """Update device configuration"""
-    if device_id not in devices:
-        return jsonify({"ok": False, "error": "Device not found"}), 404
-    
     body = request.get_json(force=True) or {}
-    device = devices[device_id]
-    
-    if "name" in body:
-        device["name"] = body["name"]
-    if "enabled" in body:
-        device["enabled"] = body["enabled"]
-    if "ip" in body:
-        device["ip"] = body["ip"]
-    if "port" in body:
-        device["port"] = body["port"]
-    
-    return jsonify({"ok": True, "data": device})
+    try:
+        with registry_lock:
+            device = devices.get(device_id)
+            if device is None:
+                return jsonify({"ok": False, "error": "Device not found"}), 404
+            config = device_config(device)
+            for key in ("name", "ip"):
+                if key in body:
+                    config[key] = body[key]
+            if "port" in body:
+                config["port"] = int(body["port"])
+            if "enabled" in body:
+                config["enabled"] = bool(body["enabled"])
+            apply_device_config(device_id, config)
+            save_device_store()
+        return jsonify({"ok": True, "data": devices.get(device_id)})
+    except Exception as error:
+        return jsonify({"ok": False, "error": str(error)}), 500
 
 
 @app.delete("/api/devices/<device_id>")
 def api_delete_device(device_id):
     """Delete a device"""
-    if device_id not in devices:
-        return jsonify({"ok": False, "error": "Device not found"}), 404
-    
-    # Stop listener if running
-    if device_id in listen_stop_events:
-        listen_stop_events[device_id].set()
-    
-    del devices[device_id]
-    return jsonify({"ok": True})
+    try:
+        with registry_lock:
+            if device_id not in devices:
+                return jsonify({"ok": False, "error": "Device not found"}), 404
+            apply_device_config(device_id, None)
+            save_device_store()
+        return jsonify({"ok": True})
+    except Exception as error:
+        return jsonify({"ok": False, "error": str(error)}), 500
 
 
 @app.get("/api/scan")
@@ -864,24 +3253,70 @@ def api_scan_devices():
     """Scan network for fingerprint devices"""
     try:
         network_range = request.args.get("range", "192.168.1")
-        devices_found = scan_network_for_devices(network_range)
+        port = int(request.args.get("port", 4370))
+        devices_found = scan_network_for_devices(network_range, port)
         return jsonify({"ok": True, "data": devices_found})
+    except ValueError as error:
+        return jsonify({"ok": False, "error": str(error)}), 400
     except Exception as error:
         return jsonify({"ok": False, "error": str(error)}), 500
 
 
+@app.get("/api/scan/stream")
+def api_scan_stream():
+    """Stream scan results as Server-Sent Events: start, device, progress, done"""
+    network_range = request.args.get("range", "192.168.1")
+    try:
+        port = int(request.args.get("port", 4370))
+        parse_scan_targets(network_range)
+    except ValueError as error:
+        return jsonify({"ok": False, "error": str(error)}), 400
+    
+    scan_id = str(next(scan_sequence))
+    cancel_event = threading.Event()
+    
+    def stream():
+        with active_scans_lock:
+            active_scans[scan_id] = cancel_event
+        scan = iter_network_scan(network_range, port, cancel_event=cancel_event)
+        try:
+            yield sse_event("start", {"scanId": scan_id, "range": network_range, "port": port})
+            for event in scan:
+                yield sse_event(event["type"], event.get("data", event))
+        finally:
+            # Also runs when the browser disconnects, which stops the sweep
+            scan.close()
+            with active_scans_lock:
+                active_scans.pop(scan_id, None)
+    
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+@app.post("/api/scan/<scan_id>/cancel")
+def api_cancel_scan(scan_id):
+    """Stop a streaming scan; devices already sent stay valid"""
+    with active_scans_lock:
+        cancel_event = active_scans.get(scan_id)
+    if cancel_event is None:
+        return jsonify({"ok": False, "error": "Scan not found or already finished"}), 404
+    cancel_event.set()
+    return jsonify({"ok": True})
+
+
 @app.get("/api/devices/<device_id>/info")
 def api_device_info(device_id):
     """Get device information"""
     try:
-        conn, device = connect_to_device(device_id)
-        info = {
-            "platform": conn.get_platform(),
-            "firmwareVersion": conn.get_firmware_version(),
-            "serialNumber": conn.get_serialnumber(),
-        }
-        device["info"] = info
-        conn.disconnect()
+        with lease_device(device_id) as (conn, device):
+            info = {
+                "platform": conn.get_platform(),
+                "firmwareVersion": conn.get_firmware_version(),
+                "serialNumber": conn.get_serialnumber(),
+            }
+        update_device(device_id, info=info)
         return jsonify({"ok": True, "data": info})
     except Exception as error:
         return jsonify({"ok": False, "error": str(error)}), 500
@@ -891,19 +3326,9 @@ def api_device_info(device_id):
 def api_get_device_users(device_id):
     """Get users from a specific device"""
     try:
-        conn, device = connect_to_device(device_id)
-        users = conn.get_users()
-        data = [
-            {
-                "uid": int(getattr(u, "uid", u.user_id)) if hasattr(u, "user_id") else int(getattr(u, "uid", 0)),
-                "userId": str(u.user_id),
-                "name": u.name,
-                "privilege": int(u.privilege) if hasattr(u, "privilege") else None,
-                "enabled": bool(u.enabled) if hasattr(u, "enabled") else True,
-            }
-            for u in users
-        ]
-        conn.disconnect()
+        refresh = request.args.get("refresh") in ("1", "true")
+        directory = load_user_directory(device_id, refresh=refresh)
+        data = [serialize_user(u) for u in directory["by_uid"].values()]
         return jsonify({"ok": True, "data": data})
     except Exception as error:
         return jsonify({"ok": False, "error": str(error)}), 500
@@ -913,113 +3338,104 @@ def api_get_device_users(device_id):
 def api_get_users():
     """Get users from all devices (aggregated)"""
     try:
+        deadline = request_deadline()
+        
+        refresh = request.args.get("refresh") in ("1", "true")
+        
+        def read_users(device_id):
+            directory = load_user_directory(device_id, refresh=refresh, timeout=deadline)
+            device = devices.get(device_id, {"name": device_id, "ip": None})
+            return [
+                dict(serialize_user(u), deviceId=device_id, deviceName=device["name"], deviceIp=device["ip"])
+                for u in directory["by_uid"].values()
+            ]
+        
         all_users = []
-        for device_id, device in devices.items():
-            if device["enabled"]:
-                try:
-                    conn, _ = connect_to_device(device_id)
-                    users = conn.get_users()
-                    device_users = [
-                        {
-                            "uid": int(getattr(u, "uid", u.user_id)) if hasattr(u, "user_id") else int(getattr(u, "uid", 0)),
-                            "userId": str(u.user_id),
-                            "name": u.name,
-                            "privilege": int(u.privilege) if hasattr(u, "privilege") else None,
-                            "enabled": bool(u.enabled) if hasattr(u, "enabled") else True,
-                            "deviceId": device_id,
-                            "deviceName": device["name"],
-                            "deviceIp": device["ip"]
-                        }
-                        for u in users
-                    ]
-                    all_users.extend(device_users)
-                    conn.disconnect()
-                except Exception as e:
-                    print(f"Error getting users from {device['name']}: {e}")
-                    continue
-        return jsonify({"ok": True, "data": all_users})
+        device_results = fan_out_to_devices(enabled_device_ids(), read_users, deadline)
+        for device_id, outcome in device_results.items():
+            if outcome["status"] == "ok":
+                device_users = outcome.pop("result")
+                outcome["count"] = len(device_users)
+                all_users.extend(device_users)
+            else:
+                log.warning("Error getting users from %s: %s", outcome["deviceName"], outcome["error"])
+        return jsonify({"ok": True, "data": all_users, "devices": device_results})
     except Exception as error:
         return jsonify({"ok": False, "error": str(error)}), 500
 
 
+@app.post("/api/users/cache/invalidate")
+def api_invalidate_user_cache():
+    """Drop cached user lists (one device with ?deviceId=, otherwise all)"""
+    device_id = request.args.get("deviceId")
+    if device_id and device_id not in devices:
+        return jsonify({"ok": False, "error": "Device not found"}), 404
+    invalidate_user_directory(device_id)
+    return jsonify({"ok": True})
+
+
 @app.post("/api/users")
 def api_set_user():
     body = request.get_json(force=True) or {}
     try:
         # Check if specific device is requested
         device_id = body.get("deviceId")
-        safe_print(f"Received device_id: {device_id} (type: {type(device_id)})")
-        safe_print(f"Available devices: {list(devices.keys())}")
+        log.debug("Received device_id: %r", device_id)
+        log.debug("Available devices: %s", list(devices))
         
         if device_id and str(device_id).strip() != '' and str(device_id) in devices:
             # Add user to specific device
-            conn, device = connect_to_device(str(device_id))
-            safe_print(f"Adding user to specific device: {device['name']} ({device['ip']}) - Device ID: {device_id}")
+            target_device_id = str(device_id)
+            explicit_device = True
         else:
             # Use default connection (first available device)
-            safe_print(f"Using default device (first enabled). Reason: device_id='{device_id}', available={list(devices.keys())}")
-            conn = connect_once()
-            device = None
-        
-        desired_user_id = clean_user_input(body.get("userId")) if body.get("userId") is not None else ""
+            log.debug("Using default device (first enabled) for device_id=%r", device_id)
+            target_device_id = default_device_id()
+            explicit_device = False
         
-        # Handle name with special care for Unicode
-        raw_name = body.get("name", "")
-        safe_print(f"Raw name received: '{raw_name}' (type: {type(raw_name)}, bytes: {raw_name.encode('utf-8') if raw_name else 'empty'})")
-        
-        desired_name = clean_user_input(raw_name)
-        safe_print(f"Cleaned name: '{desired_name}' (type: {type(desired_name)}, length: {len(desired_name)})")
-        
-        if len(desired_name) > 24:
-            desired_name = desired_name[:24]
-            safe_print(f"Name truncated to 24 chars: '{desired_name}'")
-            
-        desired_priv = const.USER_DEFAULT if body.get("privilege") is None else int(body.get("privilege"))
-        desired_pass = clean_user_input(body.get("password")) if body.get("password") else None
-        desired_enabled = bool(body.get("enabled", True))
-
-        users = conn.get_users() or []
-        provided_uid = body.get("uid")
-        if provided_uid is not None:
-            uid = int(provided_uid)
-        elif desired_user_id.isdigit():
-            uid = int(desired_user_id)
-        else:
-            uid = pick_next_uid(users)
+        fields = parse_user_fields(body)
 
-        try:
-            # Some devices require disabling before write
-            try:
-                conn.disable_device()
-            except Exception:
-                pass
+        with lease_device(target_device_id, priority=PRIORITY_ENROL) as (conn, device):
+            if explicit_device:
+                device_log(device).debug("Adding user to specific device (%s)", device["ip"])
+            
+            # Users enrolled at the keypad since the directory was loaded hold uids too
+            directory = get_user_directory(target_device_id, conn, verify=True)
+            uid = choose_uid(fields, directory["by_uid"].values())
 
-            ok, err = try_set_user_variants(
-                conn, uid, desired_user_id, desired_name, desired_priv, desired_pass, desired_enabled
-            )
-            try:
-                conn.refresh_data()
-            except Exception:
-                pass
             try:
-                conn.enable_device()
-            except Exception:
-                pass
+                # Some devices require disabling before write
+                try:
+                    conn.disable_device()
+                except Exception:
+                    pass
 
-            if not ok:
-                conn.disconnect()
-                return jsonify({"ok": False, "error": f"set_user attempts failed: {err}", "uid": uid}), 500
-        finally:
-            # Ensure device is enabled even if error
-            try:
-                conn.enable_device()
-            except Exception:
-                pass
-        conn.disconnect()
+                ok, err = try_set_user_variants(
+                    conn, uid, fields["user_id"], fields["name"], fields["privilege"], fields["password"], fields["enabled"]
+                )
+                try:
+                    conn.refresh_data()
+                except Exception:
+                    pass
+                try:
+                    conn.enable_device()
+                except Exception:
+                    pass
+
+                if not ok:
+                    invalidate_user_directory(target_device_id)
+                    return jsonify({"ok": False, "error": f"set_user attempts failed: {err}", "uid": uid}), 500
+                update_user_directory(target_device_id, added=[written_user(uid, fields)])
+            finally:
+                # Ensure device is enabled even if error
+                try:
+                    conn.enable_device()
+                except Exception:
+                    pass
         
         # Return success with device info
         response = {"ok": True}
-        if device:
+        if explicit_device:
             response["deviceInfo"] = {
                 "deviceId": device_id,
                 "deviceName": device["name"],
@@ -1031,143 +3447,96 @@ def api_set_user():
         return jsonify({"ok": False, "error": str(error)}), 500
 
 
+@app.post("/api/users/bulk")
+def api_bulk_set_users():
+    """Enrol many users on one or more devices, one disabled-device window per device"""
+    body = request.get_json(force=True) or {}
+    try:
+        users = body.get("users") if isinstance(body, dict) else None
+        if not isinstance(users, list) or not users:
+            return jsonify({"ok": False, "error": "users must be a non-empty array"}), 400
+        
+        device_ids = body.get("deviceIds") or [default_device_id()]
+        if not isinstance(device_ids, list):
+            return jsonify({"ok": False, "error": "deviceIds must be an array"}), 400
+        unknown = [str(device_id) for device_id in device_ids if str(device_id) not in devices]
+        if unknown:
+            return jsonify({"ok": False, "error": f"Unknown devices: {', '.join(unknown)}"}), 404
+        
+        entries = []
+        for user_body in users:
+            if not isinstance(user_body, dict):
+                entries.append({"userId": None, "error": "each user must be an object"})
+                continue
+            try:
+                entries.append(parse_user_fields(user_body))
+            except Exception as parse_error:
+                entries.append({"userId": user_body.get("userId"), "error": str(parse_error)})
+        
+        deadline = request_deadline(BULK_ENROL_DEADLINE)
+        device_results = fan_out_to_devices(
+            [str(device_id) for device_id in device_ids],
+            lambda device_id: enrol_users_on_device(device_id, entries, deadline),
+            deadline
+        )
+        all_ok = True
+        for outcome in device_results.values():
+            results = outcome.pop("result", [])
+            outcome["results"] = results
+            outcome["enrolled"] = sum(1 for r in results if r["ok"])
+            outcome["failed"] = len(results) - outcome["enrolled"]
+            all_ok = all_ok and outcome["status"] == "ok" and outcome["failed"] == 0
+        
+        return jsonify({"ok": all_ok, "devices": device_results})
+    except Exception as error:
+        return jsonify({"ok": False, "error": str(error)}), 500
+
+
 @app.delete("/api/users/<user_id>")
 def api_delete_user(user_id):
     """Delete user from all devices"""
     try:
         target = str(user_id)
-        safe_print(f"[DELETE] Starting deletion of user: {target}")
+        log.info("[DELETE] Starting deletion of user: %s", target)
+        deadline = request_deadline()
         deleted_from_devices = []
         failed_devices = []
         
-        # Try to delete from all enabled devices
-        for device_id, device in devices.items():
-            if not device["enabled"]:
-                safe_print(f"[DELETE] Skipping disabled device: {device['name']}")
-                continue
-                
-            safe_print(f"[DELETE] Processing device: {device['name']} ({device['ip']})")
-            
-            try:
-                conn, _ = connect_to_device(device_id)
-                safe_print(f"[DELETE] Connected to {device['name']}, attempting to delete user {target}")
-                
-                # Disable device while performing operations
-                try:
-                    conn.disable_device()
-                    safe_print(f"[DELETE] Device {device['name']} disabled for deletion")
-                except Exception as disable_error:
-                    safe_print(f"[DELETE] Warning: Could not disable device {device['name']}: {disable_error}")
-                
-                # Get all users first to find the correct uid and user_id
-                users = conn.get_users() or []
-                safe_print(f"[DELETE] Found {len(users)} users on {device['name']}")
-                
-                matched = None
-                for u in users:
-                    user_id_attr = str(getattr(u, "user_id", ""))
-                    name_attr = str(getattr(u, "name", ""))
-                    uid_attr = str(getattr(u, "uid", ""))
-                    
-                    safe_print(f"[DELETE] Checking user: user_id='{user_id_attr}', name='{name_attr}', uid='{uid_attr}'")
-                    
-                    if user_id_attr == target or name_attr == target or uid_attr == target:
-                        matched = u
-                        safe_print(f"[DELETE] Found matching user: {matched}")
-                        break
-                
-                if matched is None:
-                    safe_print(f"[DELETE] User '{target}' not found on {device['name']}")
-                    failed_devices.append(f"{device['name']}: User not found")
-                    # Re-enable device
-                    try:
-                        conn.enable_device()
-                    except Exception:
-                        pass
-                    continue
-                
-                # Try deletion with proper zk library parameters
-                deletion_success = False
-                
-                # Method 1: Try with both uid and user_id
-                try:
-                    uid_to_delete = int(getattr(matched, "uid", 0))
-                    user_id_to_delete = str(getattr(matched, "user_id", ""))
-                    
-                    safe_print(f"[DELETE] Trying deletion with uid={uid_to_delete}, user_id='{user_id_to_delete}'")
-                    conn.delete_user(uid=uid_to_delete, user_id=user_id_to_delete)
-                    deletion_success = True
-                    safe_print(f"[DELETE] SUCCESS: Deletion with uid and user_id from {device['name']}")
-                except Exception as method1_error:
-                    safe_print(f"[DELETE] Method 1 failed: {method1_error}")
-                    
-                    # Method 2: Try with uid only
-                    try:
-                        uid_to_delete = int(getattr(matched, "uid", 0))
-                        safe_print(f"[DELETE] Trying deletion with uid only: {uid_to_delete}")
-                        conn.delete_user(uid=uid_to_delete)
-                        deletion_success = True
-                        safe_print(f"[DELETE] SUCCESS: Deletion with uid only from {device['name']}")
-                    except Exception as method2_error:
-                        safe_print(f"[DELETE] Method 2 failed: {method2_error}")
-                        
-                        # Method 3: Try with user_id only
-                        try:
-                            user_id_to_delete = str(getattr(matched, "user_id", ""))
-                            safe_print(f"[DELETE] Trying deletion with user_id only: '{user_id_to_delete}'")
-                            conn.delete_user(user_id=user_id_to_delete)
-                            deletion_success = True
-                            safe_print(f"[DELETE] SUCCESS: Deletion with user_id only from {device['name']}")
-                        except Exception as method3_error:
-                            safe_print(f"[DELETE] Method 3 failed: {method3_error}")
-                            
-                            # Method 4: Try legacy method (string parameter)
-                            try:
-                                safe_print(f"[DELETE] Trying legacy deletion with string: '{target}'")
-                                conn.delete_user(target)
-                                deletion_success = True
-                                safe_print(f"[DELETE] SUCCESS: Legacy deletion from {device['name']}")
-                            except Exception as method4_error:
-                                safe_print(f"[DELETE] All deletion methods failed: {method4_error}")
-                                failed_devices.append(f"{device['name']}: All deletion methods failed")
-                
-                if deletion_success:
-                    deleted_from_devices.append(device['name'])
-                    safe_print(f"[DELETE] SUCCESS: User {target} deleted from {device['name']}")
-                
-                # Re-enable device
-                try:
-                    conn.enable_device()
-                    safe_print(f"[DELETE] Device {device['name']} re-enabled")
-                except Exception as enable_error:
-                    safe_print(f"[DELETE] Warning: Could not re-enable device {device['name']}: {enable_error}")
-                
-                conn.disconnect()
-                safe_print(f"[DELETE] Disconnected from {device['name']}")
-                
-            except Exception as device_error:
-                safe_print(f"[DELETE] Error connecting to {device['name']}: {device_error}")
-                failed_devices.append(f"{device['name']}: {device_error}")
-                continue
+        # Try to delete from all enabled devices at once
+        device_results = fan_out_to_devices(
+            enabled_device_ids(),
+            lambda device_id: remove_user_from_device(device_id, target, timeout=deadline),
+            deadline
+        )
+        for outcome in device_results.values():
+            device_name = outcome["deviceName"]
+            if outcome["status"] == "ok" and outcome["result"] == "deleted":
+                deleted_from_devices.append(device_name)
+            elif outcome["status"] == "ok":
+                failed_devices.append(f"{device_name}: User not found")
+            else:
+                failed_devices.append(f"{device_name}: {outcome['error']}")
         
-        safe_print(f"[DELETE] Final results - Deleted from: {deleted_from_devices}, Failed: {failed_devices}")
+        log.info("[DELETE] Final results - Deleted from: %s, Failed: %s", deleted_from_devices, failed_devices)
         
         if deleted_from_devices:
             return jsonify({
                 "ok": True, 
                 "message": f"User deleted from devices: {', '.join(deleted_from_devices)}",
                 "deleted_from": deleted_from_devices,
-                "failed_devices": failed_devices
+                "failed_devices": failed_devices,
+                "devices": device_results
             })
         else:
             return jsonify({
                 "ok": False, 
                 "error": f"User '{target}' not found on any device",
-                "failed_devices": failed_devices
+                "failed_devices": failed_devices,
+                "devices": device_results
             }), 404
             
     except Exception as error:
-        safe_print(f"[DELETE] Error in api_delete_user: {error}")
+        log.error("[DELETE] Error in api_delete_user: %s", error)
         return jsonify({"ok": False, "error": str(error)}), 500
 
 
@@ -1175,150 +3544,58 @@ def api_delete_user(user_id):
 def api_delete_user_from_device(device_id, user_id):
     """Delete user from specific device"""
     try:
-        if device_id not in devices:
+        device = devices.get(device_id)
+        if device is None:
             return jsonify({"ok": False, "error": "Device not found"}), 404
-        
-        device = devices[device_id]
         if not device["enabled"]:
             return jsonify({"ok": False, "error": "Device is disabled"}), 400
         
-        conn, _ = connect_to_device(device_id)
         target = str(user_id)
-        
-        safe_print(f"[DELETE] Attempting to delete user {target} from {device['name']} ({device['ip']})")
-        
-        # Disable device while performing operations
-        try:
-            conn.disable_device()
-            safe_print(f"[DELETE] Device {device['name']} disabled for deletion")
-        except Exception as disable_error:
-            safe_print(f"[DELETE] Warning: Could not disable device {device['name']}: {disable_error}")
-        
-        # Get all users first to find the correct uid and user_id
-        users = conn.get_users() or []
-        safe_print(f"[DELETE] Found {len(users)} users on {device['name']}")
-        
-        matched = None
-        for u in users:
-            user_id_attr = str(getattr(u, "user_id", ""))
-            name_attr = str(getattr(u, "name", ""))
-            uid_attr = str(getattr(u, "uid", ""))
-            
-            safe_print(f"[DELETE] Checking user: user_id='{user_id_attr}', name='{name_attr}', uid='{uid_attr}'")
-            
-            if user_id_attr == target or name_attr == target or uid_attr == target:
-                matched = u
-                safe_print(f"[DELETE] Found matching user: {matched}")
-                break
-        
-        if matched is None:
-            safe_print(f"[DELETE] User '{target}' not found on {device['name']}")
-            # Re-enable device
-            try:
-                conn.enable_device()
-            except Exception:
-                pass
-            conn.disconnect()
+        if remove_user_from_device(device_id, target) == "not_found":
             return jsonify({"ok": False, "error": f"User '{target}' not found on {device['name']}"}), 404
         
-        # Try deletion with proper zk library parameters
-        deletion_success = False
-        
-        # Method 1: Try with both uid and user_id
-        try:
-            uid_to_delete = int(getattr(matched, "uid", 0))
-            user_id_to_delete = str(getattr(matched, "user_id", ""))
-            
-            safe_print(f"[DELETE] Trying deletion with uid={uid_to_delete}, user_id='{user_id_to_delete}'")
-            conn.delete_user(uid=uid_to_delete, user_id=user_id_to_delete)
-            deletion_success = True
-            safe_print(f"[DELETE] SUCCESS: Deletion with uid and user_id from {device['name']}")
-        except Exception as method1_error:
-            safe_print(f"[DELETE] Method 1 failed: {method1_error}")
-            
-            # Method 2: Try with uid only
-            try:
-                uid_to_delete = int(getattr(matched, "uid", 0))
-                safe_print(f"[DELETE] Trying deletion with uid only: {uid_to_delete}")
-                conn.delete_user(uid=uid_to_delete)
-                deletion_success = True
-                safe_print(f"[DELETE] SUCCESS: Deletion with uid only from {device['name']}")
-            except Exception as method2_error:
-                safe_print(f"[DELETE] Method 2 failed: {method2_error}")
-                
-                # Method 3: Try with user_id only
-                try:
-                    user_id_to_delete = str(getattr(matched, "user_id", ""))
-                    safe_print(f"[DELETE] Trying deletion with user_id only: '{user_id_to_delete}'")
-                    conn.delete_user(user_id=user_id_to_delete)
-                    deletion_success = True
-                    safe_print(f"[DELETE] SUCCESS: Deletion with user_id only from {device['name']}")
-                except Exception as method3_error:
-                    safe_print(f"[DELETE] Method 3 failed: {method3_error}")
-                    
-                    # Method 4: Try legacy method (string parameter)
-                    try:
-                        safe_print(f"[DELETE] Trying legacy deletion with string: '{target}'")
-                        conn.delete_user(target)
-                        deletion_success = True
-                        safe_print(f"[DELETE] SUCCESS: Legacy deletion from {device['name']}")
-                    except Exception as method4_error:
-                        safe_print(f"[DELETE] All deletion methods failed: {method4_error}")
-                        # Re-enable device
-                        try:
-                            conn.enable_device()
-                        except Exception:
-                            pass
-                        conn.disconnect()
-                        return jsonify({"ok": False, "error": f"All deletion methods failed: {method4_error}"}), 500
-        
-        # Re-enable device
-        try:
-            conn.enable_device()
-            safe_print(f"[DELETE] Device {device['name']} re-enabled")
-        except Exception as enable_error:
-            safe_print(f"[DELETE] Warning: Could not re-enable device {device['name']}: {enable_error}")
-        
-        conn.disconnect()
-        
-        if deletion_success:
-            return jsonify({
-                "ok": True, 
-                "message": f"User deleted from {device['name']}",
-                "device": device['name']
-            })
-        else:
-            return jsonify({"ok": False, "error": f"Failed to delete user from {device['name']}"}), 500
+        return jsonify({
+            "ok": True, 
+            "message": f"User deleted from {device['name']}",
+            "device": device['name']
+        })
         
     except Exception as error:
-        safe_print(f"Error in api_delete_user_from_device: {error}")
+        log.error("Error in api_delete_user_from_device: %s", error)
         return jsonify({"ok": False, "error": str(error)}), 500
 
 
 @app.get("/api/attendance")
 def api_get_attendance():
+    """Stored punches from all devices. Query: from, to ("YYYY-MM-DD" or
+    "YYYY-MM-DD HH:MM:SS"), userId, deviceId, limit, order (asc|desc) and
+    cursor (the "next" value of the previous page)."""
     try:
-        conn = connect_once()
-        logs = conn.get_attendance()
-        data = [
-            {
-                "userId": str(att.user_id),
-                "time": att.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-            }
-            for att in (logs or [])
-        ]
-        conn.disconnect()
-        return jsonify({"ok": True, "data": data})
+        data, next_cursor = query_attendance(request.args)
+    except ValueError as error:
+        return jsonify({"ok": False, "error": str(error)}), 400
+    except Exception as error:
+        return jsonify({"ok": False, "error": str(error)}), 500
+    return jsonify({"ok": True, "data": data, "next": next_cursor})
+
+
+@app.get("/api/attendance/daily")
+def api_get_daily_attendance():
+    """First and last punch per user per day; same filters and paging as /api/attendance"""
+    try:
+        data, next_cursor = query_daily_attendance(request.args)
+    except ValueError as error:
+        return jsonify({"ok": False, "error": str(error)}), 400
     except Exception as error:
         return jsonify({"ok": False, "error": str(error)}), 500
+    return jsonify({"ok": True, "data": data, "next": next_cursor})
 
 
 @app.post("/api/attendance/clear")
 def api_clear_attendance():
     try:
-        conn = connect_once()
-        conn.clear_attendance()
-        conn.disconnect()
+        with lease_device(default_device_id()) as (conn, _):
+            conn.clear_attendance()
         return jsonify({"ok": True})
     except Exception as error:
         return jsonify({"ok": False, "error": str(error)}), 500
@@ -1344,23 +3621,183 @@ def api_listen_stop():
     return jsonify({"ok": True, "stopping": True})
 
 
+@app.get("/api/devices/<device_id>/listen")
+def api_device_listen_status(device_id):
+    """Listener state for one device: starting, running, reconnecting, stopping or stopped"""
+    if device_id not in devices:
+        return jsonify({"ok": False, "error": "Device not found"}), 404
+    return jsonify({"ok": True, "data": listener_state(device_id)})
+
+
+@app.post("/api/devices/<device_id>/listen/start")
+def api_device_listen_start(device_id):
+    """Start one device's listener, leaving the others alone"""
+    device = devices.get(device_id)
+    if device is None:
+        return jsonify({"ok": False, "error": "Device not found"}), 404
+    if not device["enabled"]:
+        return jsonify({"ok": False, "error": "Device is disabled"}), 400
+    if listener_alive(device_id) and not listen_stop_events[device_id].is_set():
+        return jsonify({"ok": True, "alreadyRunning": True, "data": listener_state(device_id)})
+    start_device_listener(device_id)
+    return jsonify({"ok": True, "started": True, "data": listener_state(device_id)})
+
+
+@app.post("/api/devices/<device_id>/listen/stop")
+def api_device_listen_stop(device_id):
+    """Stop one device's listener; returns at once unless ?wait= seconds is given"""
+    if device_id not in devices:
+        return jsonify({"ok": False, "error": "Device not found"}), 404
+    thread = stop_device_listener(device_id)
+    try:
+        wait_seconds = float(request.args.get("wait", 0))
+    except ValueError:
+        wait_seconds = 0
+    if thread is not None and wait_seconds > 0:
+        thread.join(timeout=wait_seconds)
+    data = listener_state(device_id)
+    return jsonify({"ok": True, "stopping": data["alive"], "data": data})
+
+
+@app.post("/api/devices/<device_id>/listen/restart")
+def api_device_listen_restart(device_id):
+    """Restart one device's listener on a fresh connection"""
+    device = devices.get(device_id)
+    if device is None:
+        return jsonify({"ok": False, "error": "Device not found"}), 404
+    if not device["enabled"]:
+        return jsonify({"ok": False, "error": "Device is disabled"}), 400
+    stop_device_listener(device_id)
+    # Dropped once the old listener releases it, so the new one reconnects
+    close_device_session(device_id)
+    start_device_listener(device_id)
+    return jsonify({"ok": True, "restarted": True, "data": listener_state(device_id)})
+
+
 @app.get("/api/listen/status")
 def api_listen_status():
     """Get listening status for all devices"""
-    return jsonify({"ok": True, "data": listen_status})
+    return jsonify({"ok": True, "data": listen_status_snapshot()})
 
 
-if __name__ == "__main__":
-    # Initialize default devices
-    initialize_devices()
-    safe_print(f"Initialized {len(devices)} default devices")
+@app.get("/metrics")
+def api_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.get("/api/events")
+def api_events():
+    """Push channel for dashboards: a snapshot, then device, status and punch events"""
+    subscriber = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+    
+    def snapshot():
+        return sse_event("snapshot", {
+            "devices": devices,
+            "status": listen_status_snapshot(),
+        })
+    
+    def stream():
+        with event_subscribers_lock:
+            event_subscribers.add(subscriber)
+        try:
+            yield snapshot()
+            while True:
+                try:
+                    message = subscriber.get(timeout=EVENT_KEEPALIVE)
+                except queue.Empty:
+                    # Lets the server notice tabs that went away
+                    yield ": keepalive\n\n"
+                    continue
+                yield message if message is not None else snapshot()
+        finally:
+            with event_subscribers_lock:
+                event_subscribers.discard(subscriber)
     
-    if AUTO_LISTEN:
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+def acquire_instance_lock():
+    """Take an exclusive OS lock on LOCK_FILE, or return None if another process has it"""
+    handle = open(LOCK_FILE, "a+")
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return None
+    return handle
+
+
+def start_service():
+    """Load devices and state and start the outbox sender and listeners, once per process.
+
+    A second process (for example an extra WSGI worker) would open its own
+    device sessions and forward every punch twice, so it refuses to start.
+    """
+    global service_started, instance_lock
+    with service_lock:
+        if service_started:
+            return
+        instance_lock = acquire_instance_lock()
+        if instance_lock is None:
+            raise RuntimeError(
+                f"Another listener process holds {LOCK_FILE}; run a single process (use threads, not workers)"
+            )
+        service_started = True
+        
+        # Initialize default devices
+        initialize_devices()
+        load_attendance_cursors()
+        start_outbox_sender()
+        threading.Thread(target=watch_device_store, daemon=True).start()
+        safe_print(f"Initialized {len(devices)} devices from {DEVICES_FILE}")
+        
+        if AUTO_LISTEN:
+            try:
+                start_all_listeners()
+                safe_print("Auto-started attendance listeners for all enabled devices")
+            except Exception as _e:
+                log.error("Failed to auto-start listeners: %s", _e)
+
+
+def create_app():
+    """WSGI entry point for external servers, e.g. waitress-serve --call listener:create_app"""
+    start_service()
+    return app
+
+
+def serve():
+    """Serve the API with waitress, or the Flask development server when SERVER is "dev" """
+    if SERVER != "dev":
         try:
-            start_all_listeners()
-            safe_print("Auto-started attendance listeners for all enabled devices")
-        except Exception as _e:
-            safe_print("Failed to auto-start listeners:", _e)
+            from waitress import serve as waitress_serve
+        except ImportError:
+            log.warning("waitress is not installed (pip install waitress); using the Flask development server")
+        else:
+            safe_print(f"Serving with waitress ({SERVER_THREADS} threads)")
+            waitress_serve(
+                app,
+                host=FLASK_HOST,
+                port=FLASK_PORT,
+                threads=SERVER_THREADS,
+                connection_limit=SERVER_CONNECTION_LIMIT,
+                ident="listener",
+            )
+            return
+    app.run(host=FLASK_HOST, port=FLASK_PORT, threaded=True)
+
+
+if __name__ == "__main__":
+    start_service()
     
     safe_print(f"Flask API running on http://{FLASK_HOST}:{FLASK_PORT}")
     safe_print(f"Web Interface: http://{FLASK_HOST}:{FLASK_PORT}")
@@ -1368,8 +3805,14 @@ if __name__ == "__main__":
     safe_print(f"   - GET  /api/devices - List all devices")
     safe_print(f"   - POST /api/devices - Add new device")
     safe_print(f"   - GET  /api/scan - Scan network for devices")
+    safe_print(f"   - GET  /api/scan/stream - Stream scan results (Server-Sent Events)")
     safe_print(f"   - POST /api/listen/start - Start all listeners")
     safe_print(f"   - POST /api/listen/stop - Stop all listeners")
     safe_print(f"   - GET  /api/listen/status - Get listening status")
+    safe_print(f"   - POST /api/devices/<id>/listen/start|stop|restart - Control one device's listener")
+    safe_print(f"   - GET  /api/events - Push channel for dashboards (Server-Sent Events)")
+    safe_print(f"   - GET  /api/attendance - Query stored punches (from, to, userId, deviceId, cursor)")
+    safe_print(f"   - GET  /api/attendance/daily - First/last punch per user per day")
+    safe_print(f"   - GET  /metrics - Prometheus metrics")
     
-    app.run(host=FLASK_HOST, port=FLASK_PORT)
+    serve()
@@ -0,0 +1,74 @@
+"""
+Micro-benchmark for Node delivery.
+
+Usage:
+    python scripts/bench_node_delivery.py [count] [url]
+
+Compares posts per second with a fresh requests.post per punch (the old
+send_to_node) against the listener's pooled keep-alive session. Without a
+url a local keep-alive stub server stands in for Node; pass
+http://localhost:8721/api/attendance to measure against the real app.
+"""
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import listener  # noqa: E402
+
+
+class StubNodeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this Nagle's
+    # algorithm adds ~40 ms to every keep-alive response
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b'{"ok":true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubNodeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api/attendance"
+
+
+def run(label, post, url, count):
+    payload = {"userId": "1", "time": "2024-01-01 08:00:00", "deviceIp": "bench"}
+    started = time.perf_counter()
+    for _ in range(count):
+        post(url, json=payload, timeout=3).raise_for_status()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {count} posts in {elapsed:.2f}s  ->  {count / elapsed:,.0f} posts/s")
+    return count / elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    url = sys.argv[2] if len(sys.argv) > 2 else None
+    server = None
+    if url is None:
+        server, url = start_stub_server()
+    print(f"Delivering {count} punches to {url}")
+    before = run("fresh requests.post", requests.post, url, count)
+    after = run("pooled keep-alive session", listener.get_node_session().post, url, count)
+    print(f"speedup: {after / before:.1f}x")
+    if server:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()